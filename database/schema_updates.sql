@@ -0,0 +1,58 @@
+-- 数据库结构变更脚本（按顺序执行）
+
+-- 知识库后台构建任务
+CREATE TABLE IF NOT EXISTS `kbs_job` (
+  `job_id` VARCHAR(64) NOT NULL,
+  `kon_name` VARCHAR(255) NOT NULL,
+  `status` VARCHAR(32) NOT NULL DEFAULT 'queued',
+  `stage` VARCHAR(32) NOT NULL DEFAULT 'queued',
+  `payload` LONGTEXT NOT NULL,
+  `files_total` INT DEFAULT 0,
+  `files_done` INT DEFAULT 0,
+  `chunks_total` INT DEFAULT 0,
+  `chunks_embedded` INT DEFAULT 0,
+  `failed_files` TEXT,
+  `error` TEXT,
+  `attempts` INT DEFAULT 0,
+  `created_time` DATETIME DEFAULT CURRENT_TIMESTAMP,
+  `started_time` DATETIME,
+  `stage_started_time` DATETIME,
+  `finished_time` DATETIME,
+  PRIMARY KEY (`job_id`),
+  KEY `idx_kbs_job_status` (`status`),
+  KEY `idx_kbs_job_kon_name` (`kon_name`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- 分块长度单位：char 按字符数，token 按分词器 token 数
+ALTER TABLE `knowledge` ADD COLUMN `chunk_length_unit` VARCHAR(16) DEFAULT 'char' AFTER `excel_header_processing`;
+
+-- 近似重复文档块去除：知识库相似度阈值、构建任务去除数量
+ALTER TABLE `knowledge` ADD COLUMN `dedup_threshold` FLOAT NULL AFTER `chunk_length_unit`;
+ALTER TABLE `kbs_job` ADD COLUMN `chunks_deduplicated` INT DEFAULT 0 AFTER `chunks_embedded`;
+
+-- 知识库索引类型、索引参数和构建时的召回率/延迟评测
+ALTER TABLE `knowledge` ADD COLUMN `index_type` VARCHAR(32) DEFAULT 'auto' AFTER `file_list`;
+ALTER TABLE `knowledge` ADD COLUMN `index_params` TEXT NULL AFTER `index_type`;
+ALTER TABLE `knowledge` ADD COLUMN `index_report` TEXT NULL AFTER `index_params`;
+
+-- 本地索引存储：索引文件路径和版本
+ALTER TABLE `knowledge` ADD COLUMN `index_uri` VARCHAR(512) NULL AFTER `pkl_index_data`;
+ALTER TABLE `knowledge` ADD COLUMN `index_version` INT DEFAULT 0 AFTER `index_uri`;
+
+-- 索引数据格式转换（pkl_index_data 不再重复存储索引，旧数据仍可直接读取）：
+-- python -m src.utils.migrate_index_format --dry-run
+-- python -m src.utils.migrate_index_format
+
+-- 索引摘要：列表页展示大小和向量数量时无需读取索引数据
+ALTER TABLE `knowledge` ADD COLUMN `index_size_bytes` BIGINT NULL AFTER `index_version`;
+ALTER TABLE `knowledge` ADD COLUMN `vector_count` INT NULL AFTER `index_size_bytes`;
+ALTER TABLE `knowledge` ADD COLUMN `dimension` INT NULL AFTER `vector_count`;
+
+-- BM25 稀疏索引（关键词 / 混合检索）
+ALTER TABLE `knowledge` ADD COLUMN `sparse_index_data` LONGBLOB NULL AFTER `pkl_index_data`;
+
+-- 检索相关性阈值：低于阈值的文档块不进入提示词
+ALTER TABLE `knowledge` ADD COLUMN `relevance_threshold` FLOAT NULL AFTER `sorting_config`;
+
+-- 智能体语义答案缓存开关
+ALTER TABLE `agent` ADD COLUMN `llm_answer_cache` VARCHAR(10) DEFAULT 'n' COMMENT '是否启用语义答案缓存 y/n';
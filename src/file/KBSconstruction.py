@@ -6,13 +6,24 @@ import logging
 
 from database.database import db
 from src.pojo.KBSconstruction_pojo import KBSconstruction_pojo
-from src.utils.chunk_documents import chunk_documents
-from src.utils.download_cleanup_file import download_file, cleanup_temp_file
-from src.utils.load_document import load_document
-from src.utils.vectorize_documents import vectorize_documents
+from src.pojo.kbs_job_pojo import KBSJobPojo
+from src.utils.embedding_cache import get_embedding_cache
+from src.utils.faiss_index import INDEX_TYPES, SEARCH_PARAMS, parse_index_params
+from src.utils.index_store import delete_index
+from src.utils.kbs_builder import parse_file_list, update_kbs_files, KBSFileUpdateError
+from src.utils.kbs_job_manager import kbs_job_manager
+from src.utils.temporary_message.knowledge_index_cache import knowledge_index_cache
+from src.utils.temporary_message.knowledge_warmup import knowledge_warmup
+from src.utils.temporary_message.search_multiple_kbs import search_multiple_kbs_batch
+
+# 批量检索单次请求的最大查询数
+SEARCH_BATCH_MAX_QUERIES = int(os.environ.get("KBS_SEARCH_BATCH_MAX_QUERIES", 1000))
 
 
 def KBSconstruction(app: Flask):
+    # 启动后台知识库构建线程
+    kbs_job_manager.init_app(app)
+
     @app.route('/addKBS', methods=['POST'])
     def addKBS():
         print("进入addKBS")
@@ -27,88 +38,87 @@ def KBSconstruction(app: Flask):
             if data.get(field) is None:
                 return jsonify({"error": f"Missing required field: {field}"}), 400
 
+        if data.get('index_type') and data['index_type'] not in INDEX_TYPES:
+            return jsonify({"error": f"Unsupported index_type: {data['index_type']}, "
+                                     f"expected one of {', '.join(INDEX_TYPES)}"}), 400
+
         try:
-            # 获取文件路径列表
-            file_list = data.get('file_list', [])
-            kon_name = data.get('kon_name')
-            emb_moddle = data.get('emb_moddle')
-
-            # 获取分块参数
-            chunk_setting = data.get('chunk')
-            sentence_identifier = data.get('sentence_identifier')
-            chunk_size = data.get('estimated_length_per_senction')
-            chunk_overlap = data.get('segmental_overlap_length')
-
-            # 加载所有文档
-            all_documents = []
-
-            # 处理每个文件
-            for file_url in file_list:
-                temp_file_path = None
-                try:
-                    # 下载文件到临时路径
-                    temp_file_path = download_file(file_url)
-
-                    # 验证文件是否存在
-                    if not os.path.exists(temp_file_path):
-                        raise FileNotFoundError(f"下载的文件不存在: {temp_file_path}")
-
-                    # 加载文档内容
-                    excel_header_processing = data.get('excel_header_processing', False)
-                    documents = load_document(temp_file_path, excel_header_processing)
-
-                    # 根据chunk设置分块
-                    chunked_documents = chunk_documents(
-                        documents,
-                        chunk_setting=chunk_setting,
-                        chunk_size=chunk_size,
-                        chunk_overlap=chunk_overlap,
-                        sentence_identifier=sentence_identifier
-                    )
-                    all_documents.extend(chunked_documents)
-                    print(f"分块完成，共处理 {len(chunked_documents)} 个文档块")
-
-                except Exception as e:
-                    logging.error(f"处理 OSS 文件失败: {str(e)}")
-                    raise Exception(f"处理文件 {file_url} 时出错: {str(e)}")
-                finally:
-                    # 清理临时文件
-                    try:
-                        if temp_file_path is not None and os.path.exists(temp_file_path):
-                            cleanup_temp_file(temp_file_path)
-                    except Exception as cleanup_error:
-                        logging.warning(f"清理临时文件时出错: {cleanup_error}")
-
-            print(f"下载好文档，总共 {len(all_documents)} 个文档块")
-
-            # 检查是否有文档需要处理
-            if not all_documents:
-                raise ValueError("没有有效的文档内容可以处理")
-
-            # 向量化文档
-            print("开始向量化文档")
-            faiss_index_data, pkl_index_data = vectorize_documents(all_documents, kon_name, emb_moddle)
-
-            print("向量化文档完成")
-
-            # 存储 KBS 信息到数据库
-            # 创建 data 的副本并序列化 file_list 为 JSON 字符串
-            data_to_store = data.copy()
-            data_to_store['file_list'] = json.dumps(data['file_list'])
-
-            # 添加二进制数据
-            data_to_store['faiss_index_data'] = faiss_index_data
-            data_to_store['pkl_index_data'] = pkl_index_data
-
-            new_kbs = KBSconstruction_pojo(**data_to_store)
-            db.session.add(new_kbs)
-            db.session.commit()
+            # 创建后台构建任务，立即返回任务 ID
+            job = kbs_job_manager.submit(data)
+            return jsonify({"message": "KBS build job queued", "job_id": job.job_id, "status": job.status}), 202
+        except Exception as e:
+            db.session.rollback()
+            logging.error(f"KBS构建任务创建失败: {str(e)}", exc_info=True)
+            return jsonify({"error": f"KBS构建任务创建失败: {str(e)}"}), 500
 
-            return jsonify({"message": "KBS added successfully"}), 201
+    @app.route('/embeddingCacheStats', methods=['GET'])
+    def embedding_cache_stats():
+        """
+        查询 Embedding 缓存命中统计
+        :return:
+        """
+        return jsonify(get_embedding_cache().stats()), 200
+
+    @app.route('/indexCacheStats', methods=['GET'])
+    def index_cache_stats():
+        """
+        查询知识库索引缓存统计
+        :return:
+        """
+        return jsonify(knowledge_index_cache.stats()), 200
+
+    @app.route('/getKBSJob', methods=['GET'])
+    def get_kbs_job():
+        """
+        查询知识库构建任务的状态和进度
+        :return:
+        """
+        job_id = request.args.get('job_id', '')
+        if not job_id:
+            return jsonify({"error": "Missing query parameter: job_id"}), 400
+
+        job = db.session.get(KBSJobPojo, job_id)
+        if not job:
+            return jsonify({"error": f"Job '{job_id}' not found"}), 404
+
+        return jsonify(job.to_dict()), 200
+
+    @app.route('/listKBSJobs', methods=['GET'])
+    def list_kbs_jobs():
+        """
+        列出知识库构建任务，可按 kon_name / status 过滤
+        :return:
+        """
+        query = KBSJobPojo.query
+        kon_name = request.args.get('kon_name', '')
+        status = request.args.get('status', '')
+        if kon_name:
+            query = query.filter_by(kon_name=kon_name)
+        if status:
+            query = query.filter_by(status=status)
+
+        jobs = query.order_by(KBSJobPojo.created_time.desc()).limit(100).all()
+        return jsonify([job.to_dict() for job in jobs]), 200
+
+    @app.route('/cancelKBSJob', methods=['POST'])
+    def cancel_kbs_job():
+        """
+        取消知识库构建任务
+        :return:
+        """
+        job_id = request.args.get('job_id', '')
+        if not job_id:
+            return jsonify({"error": "Missing query parameter: job_id"}), 400
+
+        try:
+            job = kbs_job_manager.cancel(job_id)
+            if not job:
+                return jsonify({"error": f"Job '{job_id}' not found"}), 404
+            return jsonify({"message": f"Job '{job_id}' cancel requested", "status": job.status}), 200
         except Exception as e:
             db.session.rollback()
-            logging.error(f"KBS创建失败: {str(e)}", exc_info=True)
-            return jsonify({"error": f"KBS创建失败: {str(e)}"}), 500
+            logging.error(f"取消KBS构建任务失败: {str(e)}", exc_info=True)
+            return jsonify({"error": f"Failed to cancel job: {str(e)}"}), 500
 
     @app.route('/selectAllKBS', methods=['GET'])
     def select_all_kbs():
@@ -171,6 +181,9 @@ def KBSconstruction(app: Flask):
             # 删除KBS
             db.session.delete(kbs_to_delete)
             db.session.commit()
+            # 删除本地索引文件和缓存
+            delete_index(kbs_to_delete)
+            knowledge_index_cache.invalidate(kon_name)
             return jsonify({"message": f"KBS '{kon_name}' deleted successfully"}), 200
         except Exception as e:
             db.session.rollback()
@@ -200,6 +213,56 @@ def KBSconstruction(app: Flask):
         # 返回KBS详情
         return jsonify(kbs.to_dict()), 200
 
+    @app.route('/searchKBSBatch', methods=['POST'])
+    def search_kbs_batch():
+        """
+        批量检索知识库，每个知识库用查询矩阵做一次向量检索
+        请求体: {"kon_names": ["kb1", "kb2"], "queries": ["q1", "q2"], "top_k": 5, "per_kb_quota": null,
+                "adaptive_cut": true}
+        adaptive_cut 为 true（默认）时按相似度断层截断，每个查询可能返回少于 top_k 个结果
+        :return: {"results": [{"query": "q1", "hits": [{"kon_name", "score", "content", "metadata"}]}]}
+        """
+        data = request.get_json() or {}
+        kon_names = data.get('kon_names') or []
+        if isinstance(kon_names, str):
+            kon_names = [n.strip() for n in kon_names.split(',') if n.strip()]
+        queries = data.get('queries') or []
+        if not kon_names or not queries:
+            return jsonify({"error": "Missing required field: kon_names / queries"}), 400
+        if not isinstance(queries, list) or not all(isinstance(q, str) for q in queries):
+            return jsonify({"error": "queries must be a list of strings"}), 400
+        if len(queries) > SEARCH_BATCH_MAX_QUERIES:
+            return jsonify({"error": f"Too many queries: {len(queries)}, "
+                                     f"at most {SEARCH_BATCH_MAX_QUERIES} per request"}), 400
+
+        try:
+            top_k = int(data.get('top_k', 5))
+            per_kb_quota = data.get('per_kb_quota')
+            per_kb_quota = int(per_kb_quota) if per_kb_quota is not None else None
+        except (TypeError, ValueError):
+            return jsonify({"error": "top_k and per_kb_quota must be integers"}), 400
+        if top_k <= 0 or (per_kb_quota is not None and per_kb_quota < 0):
+            return jsonify({"error": "top_k must be positive and per_kb_quota must not be negative"}), 400
+        adaptive = data.get('adaptive_cut', True)
+        if not isinstance(adaptive, bool):
+            return jsonify({"error": "adaptive_cut must be a boolean"}), 400
+
+        try:
+            results = search_multiple_kbs_batch(kon_names, queries, top_k=top_k, per_kb_quota=per_kb_quota,
+                                                adaptive=adaptive)
+        except Exception as e:
+            logging.error(f"批量检索失败: {str(e)}", exc_info=True)
+            return jsonify({"error": f"Failed to search KBS: {str(e)}"}), 500
+
+        return jsonify({"results": [
+            {
+                "query": query,
+                "hits": [{"kon_name": name, "score": round(float(score), 6),
+                          "content": doc.page_content, "metadata": doc.metadata} for doc, score, name in hits]
+            }
+            for query, hits in zip(queries, results)
+        ]}), 200
+
     @app.route('/updateKBSByOriginalName', methods=['PUT'])
     def update_kbs_by_original_name():
         """
@@ -224,31 +287,100 @@ def KBSconstruction(app: Flask):
             return jsonify({"error": f"KBS with name '{original_kon_name}' not found"}), 404
 
         try:
+            # file_list 变化时增量更新索引：只向量化新增文件，删除移除文件的向量
+            file_update = None
+            if 'file_list' in data:
+                old_files = parse_file_list(kbs_to_update.file_list)
+                new_files = parse_file_list(data['file_list'])
+                file_update = update_kbs_files(
+                    kbs_to_update,
+                    add_files=[f for f in new_files if f not in old_files],
+                    remove_files=[f for f in old_files if f not in new_files]
+                )
+                knowledge_index_cache.invalidate(original_kon_name)
+
             # 更新字段（除了二进制数据和主键）
             updatable_fields = [
                 'kon_name', 'kon_describe', 'emb_moddle', 'chunk', 'sentence_identifier',
                 'estimated_length_per_senction', 'segmental_overlap_length',
-                'excel_header_processing', 'similarity', 'MROD', 'sorting_config'
+                'excel_header_processing', 'similarity', 'MROD', 'sorting_config', 'dedup_threshold',
+                'relevance_threshold', 'chunk_length_unit'
             ]
 
-            # file_list 需要特殊处理
-            if 'file_list' in data:
-                # 序列化 file_list 为 JSON 字符串
-                data['file_list'] = json.dumps(data['file_list'])
-
             # 更新可更新的字段
             for field in updatable_fields:
                 if field in data:
                     setattr(kbs_to_update, field, data[field])
 
-            # 如果 file_list 在更新数据中，也进行更新
-            if 'file_list' in data:
-                setattr(kbs_to_update, 'file_list', data['file_list'])
+            # 查询时参数（nprobe / efSearch）无需重建索引，合并到已有索引参数中
+            search_params = {k: v for k, v in parse_index_params(data.get('index_params')).items() if k in SEARCH_PARAMS}
+            if search_params:
+                index_params = parse_index_params(kbs_to_update.index_params)
+                index_params.update(search_params)
+                kbs_to_update.index_params = json.dumps(index_params)
+                knowledge_index_cache.invalidate(original_kon_name)
 
             # 提交更改
             db.session.commit()
-            return jsonify({"message": f"KBS '{original_kon_name}' updated successfully"}), 200
+            knowledge_index_cache.invalidate(original_kon_name)
+            result = {"message": f"KBS '{original_kon_name}' updated successfully"}
+            if file_update is not None:
+                # 索引已重新保存，后台预热，避免第一次查询时冷加载
+                knowledge_warmup.schedule([kbs_to_update.kon_name])
+                result.update(file_update)
+            return jsonify(result), 200
+        except KBSFileUpdateError as e:
+            db.session.rollback()
+            return jsonify({"error": str(e)}), 400
         except Exception as e:
             db.session.rollback()
             logging.error(f"更新KBS失败: {str(e)}", exc_info=True)
             return jsonify({"error": f"Failed to update KBS: {str(e)}"}), 500
+
+    @app.route('/addKBSFiles', methods=['POST'])
+    def add_kbs_files():
+        """
+        向知识库增量添加文件，只向量化新文件的文档块
+        请求体: {"kon_name": "...", "file_list": ["url1", "url2"]}
+        :return:
+        """
+        return _update_files(add=True)
+
+    @app.route('/removeKBSFiles', methods=['POST'])
+    def remove_kbs_files():
+        """
+        从知识库增量移除文件，按来源删除对应向量
+        请求体: {"kon_name": "...", "file_list": ["url1", "url2"]}
+        :return:
+        """
+        return _update_files(add=False)
+
+    def _update_files(add):
+        data = request.get_json() or {}
+        kon_name = data.get('kon_name', '')
+        file_list = data.get('file_list')
+
+        if not kon_name:
+            return jsonify({"error": "Missing required field: kon_name"}), 400
+        if not file_list:
+            return jsonify({"error": "Missing required field: file_list"}), 400
+
+        kbs = KBSconstruction_pojo.query.filter_by(kon_name=kon_name).first()
+        if not kbs:
+            return jsonify({"error": f"KBS with name '{kon_name}' not found"}), 404
+
+        try:
+            if add:
+                result = update_kbs_files(kbs, add_files=file_list)
+            else:
+                result = update_kbs_files(kbs, remove_files=file_list)
+            knowledge_index_cache.invalidate(kon_name)
+            knowledge_warmup.schedule([kon_name])
+            return jsonify(result), 200
+        except KBSFileUpdateError as e:
+            db.session.rollback()
+            return jsonify({"error": str(e)}), 400
+        except Exception as e:
+            db.session.rollback()
+            logging.error(f"增量更新KBS文件失败: {str(e)}", exc_info=True)
+            return jsonify({"error": f"Failed to update KBS files: {str(e)}"}), 500
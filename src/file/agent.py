@@ -1,12 +1,17 @@
 # agent.py
+import json
+import time
 import traceback
 from flask import current_app
 from flask import request
+from flask import Response, stream_with_context
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
 from database.database import db
 from src.pojo.agent_pojo import AgentPojo
-from src.utils.temporary_message.search_multiple_kbs import search_multiple_kbs
+from src.utils.temporary_message.search_multiple_kbs import search_multiple_kbs_with_scores, get_model_embeddings
+from src.utils.temporary_message.answer_cache import (answer_cache, answer_fingerprint, knowledge_versions,
+                                                      ANSWER_CACHE_EMB_MODEL)
 from src.utils.tongti_Trub import get_chat_completion
 from src.utils.temporary_message.model_service import ModelService
 from src.utils.temporary_message.prompt_builder import PromptBuilder
@@ -22,6 +27,8 @@ from transformers import GPT2Tokenizer
 knowledge_cache = {}
 # 全局缓存字典，用于存储图片和文件解析结果
 tool_cache = {}
+# 每次对话最多检索的知识库文档块数（实际数量由相关性阈值和分数断层决定）
+KNOWLEDGE_TOP_K = 5
 # 初始化分词器（可以根据实际使用的模型调整）
 tokenizer = GPT2Tokenizer.from_pretrained("gpt2")
 
@@ -51,7 +58,8 @@ def agent(app):
                 llm_memory=data.get('llm_memory'),
                 llm_maximum_length_of_reply=data.get('llm_maximum_length_of_reply'),
                 llm_carry_number_of_rounds_of_context=data.get('llm_carry_number_of_rounds_of_context'),
-                llm_temperature_coefficient=data.get('llm_temperature_coefficient')
+                llm_temperature_coefficient=data.get('llm_temperature_coefficient'),
+                llm_answer_cache=data.get('llm_answer_cache', 'n')
             )
             # 将记录添加到数据库
             db.session.add(agent)
@@ -85,7 +93,8 @@ def agent(app):
                     'llm_memory': agent.llm_memory,
                     'llm_maximum_length_of_reply': agent.llm_maximum_length_of_reply,
                     'llm_carry_number_of_rounds_of_context': agent.llm_carry_number_of_rounds_of_context,
-                    'llm_temperature_coefficient': agent.llm_temperature_coefficient
+                    'llm_temperature_coefficient': agent.llm_temperature_coefficient,
+                    'llm_answer_cache': agent.llm_answer_cache
                 }
                 for agent in agents
             ]
@@ -159,8 +168,11 @@ def agent(app):
                                                                    agent.llm_carry_number_of_rounds_of_context)
             agent.llm_temperature_coefficient = data.get('llm_temperature_coefficient',
                                                          agent.llm_temperature_coefficient)
+            agent.llm_answer_cache = data.get('llm_answer_cache', agent.llm_answer_cache)
 
             db.session.commit()
+            # 配置变化后旧答案的指纹不会再命中，直接释放
+            answer_cache.invalidate(agent_id)
 
             return {'message': '智能体信息已成功更新！'}, 200
 
@@ -169,121 +181,284 @@ def agent(app):
             db.session.rollback()
             return {'error': str(e)}, 500
 
-    @app.route('/processAgent/<agent_id>', methods=['POST'])
-    def process_agent(agent_id):
-        try:
-            data = request.json
+    def prepare_agent_call(agent_id, data):
+        """
+        对话前的准备：加载历史、查找缓存答案、并行检索知识库和调用工具、加载模型、构建提示词
+        :return: 上下文字典，命中答案缓存时 cached 为缓存的答案，不再检索和加载模型
+        """
+        # 0. 加载对话历史，启用答案缓存时先查找相似问题的缓存答案
+        context = {
+            'message': data.get("message"),
+            'user_id': data.get("user_id"),
+            'llm_memory': data.get("llm_memory", "n"),
+            'cached': None,
+            'retrieval_metrics': {}
+        }
+        max_rounds = int(data.get("llm_carry_number_of_rounds_of_context", 10))
+        history = ConversationManager.load_conversation_history(context['user_id'], agent_id,
+                                                                context['llm_memory'], max_rounds)
 
-            # 1. 并行处理知识库搜索和工具调用
-            additional_info = ""
-            tool_results = []
-            user_id = ""
-
-            app = current_app._get_current_object()
-
-            # 使用线程池并行执行 - 使用全局导入的 ThreadPoolExecutor
-            with ThreadPoolExecutor(max_workers=10) as executor:
-                knowledge_future = executor.submit(
-                    process_knowledge_search_with_app,
-                    app, data.get("llm_knowledge"), data.get("message")
-                )
-                tools_future = executor.submit(
-                    process_tools,
-                    data.get("llm_image"), data.get("llm_file"),
-                    data.get("llm_internet"), data.get("message", "")
-                )
-
-                additional_info = knowledge_future.result()
-                tool_results = tools_future.result()
-
-            # 2. 获取模型信息（缓存优化）
-            result = ModelService.get_model_info(data.get("llm_api"))
-            if isinstance(result, dict) and result.get("error"):
-                return {'error': result["error"]}, 500
-
-            model_name, model_key = result
-
-            # 添加模型缓存
-            model_cache = {}
-
-            def get_cached_model(model_name, api_key, temperature, max_tokens):
-                cache_key = f"{model_name}_{api_key}_{temperature}_{max_tokens}"
-
-                if cache_key in model_cache:
-                    return model_cache[cache_key]
-
-                model = load_model(model_name, api_key, temperature, max_tokens)
-                model_cache[cache_key] = model
-                return model
-
-            # 3. 使用缓存的模型实例
-            llm_instance = get_cached_model(
-                model_name=model_name,
-                api_key=model_key,
-                temperature=float(data.get("llm_temperature_coefficient", 0.8)),
-                max_tokens=int(data.get("llm_maximum_length_of_reply", 2048))
+        cache_error = None
+        try:
+            answer_key = answer_cache_key(data, history)
+        except Exception as e:
+            # 向量化问题失败时不使用缓存，继续正常检索和生成
+            print("🔥 答案缓存向量化问题出错，跳过缓存:", str(e))
+            answer_key, cache_error = None, str(e)
+        cache_stats = {'enabled': answer_key is not None, 'hit': False}
+        if cache_error is not None:
+            cache_stats['error'] = cache_error
+        context.update(answer_key=answer_key, cache_stats=cache_stats)
+        if answer_key is not None:
+            cached, similarity, cached_question = answer_cache.lookup(agent_id, *answer_key)
+            cache_stats['similarity'] = similarity
+            if cached is not None:
+                cache_stats.update(hit=True, cached_question=cached_question)
+                context['cached'] = cached
+                return context
+
+        # 1. 并行处理知识库搜索和工具调用
+        app = current_app._get_current_object()
+
+        # 使用线程池并行执行 - 使用全局导入的 ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            knowledge_future = executor.submit(
+                process_knowledge_search_with_app,
+                app, data.get("llm_knowledge"), data.get("message")
             )
-
-            # 4. 加载对话历史
-            user_id = data.get("user_id")
-            llm_memory = data.get("llm_memory", "n")
-            max_rounds = int(data.get("llm_carry_number_of_rounds_of_context", 10))
-            history = ConversationManager.load_conversation_history(user_id, agent_id, llm_memory, max_rounds)
-
-            # 5. 构建提示词
-            prompt_template = build_optimized_prompt(
-                llm_prompt=data.get("llm_prompt"),
-                additional_info=additional_info,
-                tool_results=tool_results,
-                history=history,
-                message=data.get("message")
+            tools_future = executor.submit(
+                process_tools,
+                data.get("llm_image"), data.get("llm_file"),
+                data.get("llm_internet"), data.get("message", "")
             )
 
-            # 6. 调用模型
-            prompt = PromptTemplate.from_template(prompt_template)
-            llm_chain = LLMChain(prompt=prompt, llm=llm_instance)
-            result = llm_chain.run(message=data.get("message"))
+            additional_info, context['retrieval_metrics'] = knowledge_future.result()
+            tool_results = tools_future.result()
+
+        # 2. 获取模型信息（缓存优化）
+        result = ModelService.get_model_info(data.get("llm_api"))
+        if isinstance(result, dict) and result.get("error"):
+            raise ValueError(result["error"])
+
+        model_name, model_key = result
+
+        # 3. 加载模型实例
+        context['llm'] = load_model(
+            model_name,
+            model_key,
+            float(data.get("llm_temperature_coefficient", 0.8)),
+            int(data.get("llm_maximum_length_of_reply", 2048))
+        )
+
+        # 4. 构建提示词
+        context['prompt_template'] = build_optimized_prompt(
+            llm_prompt=data.get("llm_prompt"),
+            additional_info=additional_info,
+            tool_results=tool_results,
+            history=history,
+            message=data.get("message")
+        )
+        return context
 
-            # 计算字数和 token 数量
-            char_count = len(result)  # 字符数
-            input_tokens = len(tokenizer.encode(data.get("message")))  # 输入 token 数
-            output_tokens = len(tokenizer.encode(result))  # 输出 token 数
-
-            # 构造返回结果
-            response_data = {
-                'result': result,
-                'stats': {
-                    'char_count': char_count,
-                    'input_tokens': input_tokens,
-                    'output_tokens': output_tokens
-                }
-            }
+    @app.route('/processAgent/<agent_id>', methods=['POST'])
+    def process_agent(agent_id):
+        try:
+            data = request.json
+            context = prepare_agent_call(agent_id, data)
+            cache_stats = context['cache_stats']
+            if context['cached'] is not None:
+                return finish_response(agent_id, context, context['cached'],
+                                       {'answer_cache': dict(cache_stats, **answer_cache_counts())})
+
+            # 5. 调用模型
+            prompt = PromptTemplate.from_template(context['prompt_template'])
+            llm_chain = LLMChain(prompt=prompt, llm=context['llm'])
+            result = llm_chain.run(message=data.get("message"))
 
-            # 7. 异步保存对话历史 - 使用新的线程池
-            with ThreadPoolExecutor(max_workers=1) as save_executor:
-                save_executor.submit(
-                    ConversationManager.save_conversation,
-                    user_id, agent_id,
-                    data.get("message"), result, llm_memory
-                )
+            # 6. 缓存答案
+            if context['answer_key'] is not None:
+                answer_cache.store(agent_id, *context['answer_key'], data.get("message"), result)
 
-            return response_data, 200
+            return finish_response(agent_id, context, result, {
+                'retrieval': context['retrieval_metrics'],
+                'answer_cache': dict(cache_stats, **answer_cache_counts())
+            })
 
         except Exception as e:
             print("🔥 处理智能体时出错:", str(e))
             traceback.print_exc()
             return {'error': str(e)}, 500
 
+    @app.route('/processAgentStream/<agent_id>', methods=['POST'])
+    def process_agent_stream(agent_id):
+        """
+        流式对话（Server-Sent Events），请求体与 /processAgent 相同
+        事件：retrieval（检索完成及统计）、token（模型输出片段）、done（最终统计）、error
+        客户端断开时关闭上游模型请求，未完成的回答不保存到对话历史
+        """
+        data = request.json
+        started = time.perf_counter()
+
+        def elapsed_ms():
+            return round((time.perf_counter() - started) * 1000, 1)
+
+        def generate():
+            try:
+                context = prepare_agent_call(agent_id, data)
+            except Exception as e:
+                print("🔥 处理智能体时出错:", str(e))
+                traceback.print_exc()
+                yield sse_event('error', {'error': str(e)})
+                return
+
+            cache_stats = context['cache_stats']
+            yield sse_event('retrieval', {
+                'retrieval': context['retrieval_metrics'],
+                'answer_cache': cache_stats,
+                'elapsed_ms': elapsed_ms()
+            })
+
+            if context['cached'] is not None:
+                result = context['cached']
+                first_token_ms = elapsed_ms()
+                yield sse_event('token', {'content': result})
+            else:
+                # 5. 流式调用模型
+                prompt_text = PromptTemplate.from_template(context['prompt_template']).format(message=data.get("message"))
+                upstream = context['llm'].stream(prompt_text)
+                parts = []
+                first_token_ms = None
+                completed = False
+                try:
+                    for chunk in upstream:
+                        content = chunk.content if hasattr(chunk, 'content') else str(chunk)
+                        if not content:
+                            continue
+                        if first_token_ms is None:
+                            first_token_ms = elapsed_ms()
+                        parts.append(content)
+                        yield sse_event('token', {'content': content})
+                    completed = True
+                except GeneratorExit:
+                    print(f"客户端断开连接，取消智能体 {agent_id} 的模型调用")
+                    raise
+                except Exception as e:
+                    print("🔥 流式调用模型出错:", str(e))
+                    traceback.print_exc()
+                    yield sse_event('error', {'error': str(e)})
+                    return
+                finally:
+                    if not completed:
+                        # 关闭上游生成器，释放与模型服务的连接
+                        upstream.close()
+
+                result = "".join(parts)
+                # 6. 缓存答案
+                if context['answer_key'] is not None:
+                    answer_cache.store(agent_id, *context['answer_key'], data.get("message"), result)
+
+            stats = build_stats(context['message'], result, {
+                'retrieval': context['retrieval_metrics'],
+                'answer_cache': dict(cache_stats, **answer_cache_counts()),
+                'time_to_first_token_ms': first_token_ms,
+                'total_ms': elapsed_ms()
+            })
+            save_history(agent_id, context, result)
+            yield sse_event('done', {'stats': stats})
+
+        return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    def sse_event(event, payload):
+        """
+        格式化一条 Server-Sent Events 消息
+        """
+        return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+    def build_stats(message, result, extra_stats):
+        """
+        计算回复的字数和 token 数量
+        """
+        return dict({
+            'char_count': len(result),  # 字符数
+            'input_tokens': len(tokenizer.encode(message)),  # 输入 token 数
+            'output_tokens': len(tokenizer.encode(result))  # 输出 token 数
+        }, **extra_stats)
+
+    def save_history(agent_id, context, result):
+        """
+        异步保存对话历史 - 使用新的线程池
+        """
+        with ThreadPoolExecutor(max_workers=1) as save_executor:
+            save_executor.submit(
+                ConversationManager.save_conversation,
+                context['user_id'], agent_id,
+                context['message'], result, context['llm_memory']
+            )
+
+    def finish_response(agent_id, context, result, extra_stats):
+        """
+        构造返回结果并保存对话历史
+        """
+        response_data = {
+            'result': result,
+            'stats': build_stats(context['message'], result, extra_stats)
+        }
+        save_history(agent_id, context, result)
+        return response_data, 200
+
+    def answer_cache_key(data, history):
+        """
+        答案缓存的查找键 (问题向量, 指纹)
+        只有回答不依赖对话历史、联网搜索和上传的图片/文件时才使用缓存，否则返回 None
+        """
+        if data.get("llm_answer_cache") != "y" or not data.get("message"):
+            return None
+        if history or data.get("llm_internet") == "y":
+            return None
+        if (data.get("llm_image") == "y" or data.get("llm_file") == "y") and tool_cache:
+            return None
+
+        kb_names = [n.strip() for n in (data.get("llm_knowledge") or "").split(",") if n.strip()]
+        agent_config = {field: data.get(field) for field in (
+            "llm_api", "llm_prompt", "llm_knowledge", "llm_maximum_length_of_reply", "llm_temperature_coefficient")}
+        fingerprint = answer_fingerprint(agent_config, knowledge_versions(kb_names))
+        vector = get_model_embeddings(ANSWER_CACHE_EMB_MODEL).embed_query(data.get("message"))
+        return vector, fingerprint
+
+    def answer_cache_counts():
+        stats = answer_cache.stats()
+        return {'hits': stats['hits'], 'misses': stats['misses']}
+
+    @app.route('/answerCacheStats', methods=['GET'])
+    def answer_cache_stats():
+        """
+        查询语义答案缓存统计
+        """
+        return answer_cache.stats(), 200
+
     # 子线程内部已经 push 过上下文，这里可以直接用
     def process_knowledge_search(llm_knowledge, message):
+        """
+        检索知识库，按知识库分块拼接结果；没有结果通过相关性阈值的知识库不生成分块
+        :return: (知识文本, 检索统计)
+        """
+        metrics = {}
         if not llm_knowledge or not llm_knowledge.strip():
-            return "无相关知识"
+            return "无相关知识", metrics
         kb_names = [n.strip() for n in llm_knowledge.split(",") if n.strip()]
         if not kb_names:
-            return "无相关知识"
+            return "无相关知识", metrics
         # 下面这行需要上下文，但此时早已在 with app.app_context(): 里
-        docs = search_multiple_kbs(kb_names, message, top_k=5)
-        return "\n".join([d.page_content for d in docs]) if docs else "无相关知识"
+        results = search_multiple_kbs_with_scores(kb_names, message, top_k=KNOWLEDGE_TOP_K, metrics=metrics)
+        print("知识库检索统计:", metrics)
+
+        blocks = []
+        for name in kb_names:
+            contents = [doc.page_content for doc, _, kon_name in results if kon_name == name]
+            if contents:
+                blocks.append(f"【{name}】\n" + "\n".join(contents))
+        return ("\n\n".join(blocks) if blocks else "无相关知识"), metrics
 
     def process_knowledge_search_with_app(app, llm_knowledge, message):
         with app.app_context():
@@ -506,7 +681,8 @@ def agent(app):
                 'llm_memory': agent.llm_memory,
                 'llm_maximum_length_of_reply': agent.llm_maximum_length_of_reply,
                 'llm_carry_number_of_rounds_of_context': agent.llm_carry_number_of_rounds_of_context,
-                'llm_temperature_coefficient': agent.llm_temperature_coefficient
+                'llm_temperature_coefficient': agent.llm_temperature_coefficient,
+                'llm_answer_cache': agent.llm_answer_cache
             }
 
             return result, 200
@@ -527,6 +703,7 @@ def agent(app):
             # 从数据库中删除记录
             db.session.delete(agent)
             db.session.commit()
+            answer_cache.invalidate(agent_id)
 
             return {'message': f'智能体 {agent_id} 已成功删除！'}, 200
 
@@ -0,0 +1,30 @@
+from flask import jsonify
+
+from src.utils.temporary_message.knowledge_index_cache import knowledge_index_cache
+from src.utils.temporary_message.knowledge_warmup import knowledge_warmup
+
+
+def health(app):
+    # 启动后台知识库预热线程
+    knowledge_warmup.init_app(app)
+
+    @app.route('/health', methods=['GET'])
+    def health_check():
+        """
+        存活探针：进程可以处理请求即返回 200
+        :return:
+        """
+        return jsonify({"status": "ok"}), 200
+
+    @app.route('/ready', methods=['GET'])
+    def ready_check():
+        """
+        就绪探针：启动预热完成后返回 200，否则返回 503 和预热进度
+        :return:
+        """
+        result = {
+            "ready": knowledge_warmup.is_ready(),
+            "warmup": knowledge_warmup.progress(),
+            "index_cache": knowledge_index_cache.stats()
+        }
+        return jsonify(result), 200 if result["ready"] else 503
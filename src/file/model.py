@@ -3,6 +3,7 @@ from datetime import datetime
 from flask import request, jsonify
 from database.database import db
 from src.pojo.model_pojo import ModelPojo
+from src.utils.temporary_message.model_loader import llm_registry
 
 def model(app):
     @app.route('/addModel', methods=['POST'])
@@ -36,6 +37,13 @@ def model(app):
             db.session.rollback()
             return jsonify({'error': '创建模型失败，请重试'}), 500
 
+    @app.route('/llmClientStats', methods=['GET'])
+    def llm_client_stats():
+        """
+        查询共享模型客户端的缓存统计
+        """
+        return jsonify(llm_registry.stats()), 200
+
     @app.route('/listModels', methods=['GET'])
     def list_models():
         try:
@@ -1,5 +1,6 @@
 from datetime import datetime
 from sqlalchemy.dialects.mysql import LONGBLOB
+from sqlalchemy.orm import deferred
 from database.database import db
 
 class KBSconstruction_pojo(db.Model):
@@ -14,17 +15,36 @@ class KBSconstruction_pojo(db.Model):
     estimated_length_per_senction = db.Column(db.Integer, nullable=False)
     segmental_overlap_length = db.Column(db.Integer, nullable=False)
     excel_header_processing = db.Column(db.String(10), nullable=False)
+    chunk_length_unit = db.Column(db.String(16), nullable=True, default='char')  # 分块长度单位：char / token
+    dedup_threshold = db.Column(db.Float, nullable=True)  # 近似重复去除的相似度阈值，为空时使用默认值
     similarity = db.Column(db.String(255), nullable=False)
     MROD = db.Column(db.String(255), nullable=False)
     sorting_config = db.Column(db.String(255), nullable=False)
+    relevance_threshold = db.Column(db.Float, nullable=True)  # 检索结果的最低相关性分数，为空时不过滤
     file_list = db.Column(db.Text, nullable=False)
-    update_time = db.Column(db.DateTime, default=db.func.current_timestamp())
-    faiss_index_data = db.Column(LONGBLOB, nullable=True)  # 存储 index.faiss 的二进制数据
-    pkl_index_data = db.Column(LONGBLOB, nullable=True)    # 存储 index.pkl 的二进制数据
+    index_type = db.Column(db.String(32), nullable=True, default='auto')  # 索引类型：auto/Flat/IVF-Flat/IVF-PQ/HNSW
+    index_params = db.Column(db.Text, nullable=True)  # 索引参数 JSON（nlist、m、M、nprobe、efSearch 等）
+    index_report = db.Column(db.Text, nullable=True)  # 构建时的召回率/延迟评测 JSON
+    update_time = db.Column(db.DateTime, default=db.func.current_timestamp(), onupdate=db.func.current_timestamp())
+    # 索引二进制数据延迟加载（同组的列一起加载），查询元数据时不会从数据库读取
+    faiss_index_data = deferred(db.Column(LONGBLOB, nullable=True), group='index_data')  # 存储 index.faiss 的二进制数据
+    pkl_index_data = deferred(db.Column(LONGBLOB, nullable=True), group='index_data')    # 存储 docstore 的二进制数据
+    sparse_index_data = deferred(db.Column(LONGBLOB, nullable=True), group='index_data')  # 存储 BM25 稀疏索引
+    index_uri = db.Column(db.String(512), nullable=True)    # 本地索引存储的相对路径，为空时索引在上面两列中
+    index_version = db.Column(db.Integer, nullable=True, default=0)  # 索引版本，每次重建或增量更新递增
+    index_size_bytes = db.Column(db.BigInteger, nullable=True)  # 索引数据总大小（字节），保存索引时更新
+    vector_count = db.Column(db.Integer, nullable=True)         # 向量数量
+    dimension = db.Column(db.Integer, nullable=True)            # 向量维度
+
+    # 不返回给前端的二进制列
+    INDEX_BLOB_COLUMNS = ('faiss_index_data', 'pkl_index_data', 'sparse_index_data')
 
     def to_dict(self):
         result = {}
         for c in self.__table__.columns:
+            # 按列名跳过二进制数据，避免访问属性时触发延迟加载
+            if c.name in self.INDEX_BLOB_COLUMNS:
+                continue
             value = getattr(self, c.name)
             # 如果是 datetime 类型，格式化为字符串
             if isinstance(value, datetime):
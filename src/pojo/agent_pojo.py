@@ -16,4 +16,5 @@ class AgentPojo(db.Model):
     llm_memory = db.Column(db.Text)
     llm_maximum_length_of_reply = db.Column(db.Double)
     llm_carry_number_of_rounds_of_context = db.Column(db.Integer)
-    llm_temperature_coefficient = db.Column(db.String(255))
\ No newline at end of file
+    llm_temperature_coefficient = db.Column(db.String(255))
+    llm_answer_cache = db.Column(db.String(10), default='n', comment='是否启用语义答案缓存 y/n')
@@ -0,0 +1,57 @@
+import json
+from datetime import datetime
+from sqlalchemy.dialects.mysql import LONGTEXT
+from database.database import db
+
+class KBSJobPojo(db.Model):
+    __tablename__ = 'kbs_job'
+
+    job_id = db.Column(db.String(64), primary_key=True, nullable=False)
+    kon_name = db.Column(db.String(255), nullable=False)
+    status = db.Column(db.String(32), nullable=False, default='queued')  # queued/running/succeeded/failed/cancelled
+    stage = db.Column(db.String(32), nullable=False, default='queued')   # queued/downloading/embedding/saving/done
+    payload = db.Column(LONGTEXT, nullable=False)     # /addKBS 请求体 JSON，用于重启后恢复
+    files_total = db.Column(db.Integer, default=0)
+    files_done = db.Column(db.Integer, default=0)
+    chunks_total = db.Column(db.Integer, default=0)
+    chunks_embedded = db.Column(db.Integer, default=0)
+    chunks_deduplicated = db.Column(db.Integer, default=0)  # 近似重复去除的文档块数
+    failed_files = db.Column(db.Text)
+    error = db.Column(db.Text)
+    attempts = db.Column(db.Integer, default=0)
+    created_time = db.Column(db.DateTime, default=db.func.current_timestamp())
+    started_time = db.Column(db.DateTime)
+    stage_started_time = db.Column(db.DateTime)
+    finished_time = db.Column(db.DateTime)
+
+    def eta_seconds(self):
+        """
+        根据当前阶段的处理速度估算剩余时间（秒），无法估算时返回 None
+        """
+        if self.status != 'running' or not self.stage_started_time:
+            return None
+        if self.stage == 'downloading':
+            done, total = self.files_done or 0, self.files_total or 0
+        elif self.stage == 'embedding':
+            done, total = self.chunks_embedded or 0, self.chunks_total or 0
+        else:
+            return None
+        if done <= 0 or total <= done:
+            return None
+        elapsed = (datetime.now() - self.stage_started_time).total_seconds()
+        return round(elapsed / done * (total - done), 1)
+
+    def to_dict(self):
+        result = {}
+        for c in self.__table__.columns:
+            if c.name == 'payload':
+                continue
+            value = getattr(self, c.name)
+            # 如果是 datetime 类型，格式化为字符串
+            if isinstance(value, datetime):
+                result[c.name] = value.strftime('%Y-%m-%d %H:%M:%S')
+            else:
+                result[c.name] = value
+        result['failed_files'] = json.loads(self.failed_files) if self.failed_files else []
+        result['eta_seconds'] = self.eta_seconds()
+        return result
@@ -3,10 +3,12 @@ from src.file.folder import folder
 from src.file.KBSconstruction import KBSconstruction
 from src.file.agent import agent
 from src.file.model import model
+from src.file.health import health
 
 def register_routes(app):
     folder(app)
     KBSconstruction(app)
     agent(app)
     model(app)
+    health(app)
 
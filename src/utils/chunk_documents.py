@@ -1,29 +1,59 @@
 # src/utils/chunk_documents.py
 
 from langchain.text_splitter import RecursiveCharacterTextSplitter, CharacterTextSplitter
+from langchain.schema import Document
 import re
 
+from src.utils.token_splitter import TokenTextSplitter, count_tokens
+
+# 表格行打包模式的切分标识
+ROW_PACKING_IDENTIFIER = "按表格行"
+# 分块长度单位
+LENGTH_UNIT_CHAR = "char"
+LENGTH_UNIT_TOKEN = "token"
+
 
 def chunk_documents(documents, chunk_setting, chunk_size, chunk_overlap,
-                    sentence_identifier):
+                    sentence_identifier, length_unit=LENGTH_UNIT_CHAR):
     """
     对文档进行分块处理
     Args:
-        documents: 文档列表
+        documents: 文档列表或生成器（只遍历一次）
         chunk_setting: 切分规则（"default", "custom"）
-        sentence_identifier: 切分规则（"按页面","按一级标题","按二级标题","按长度"）
-        chunk_size: 每个chunk的目标token数，默认600
-        chunk_overlap: chunk间的重叠token数，默认100
+        sentence_identifier: 切分规则（"按页面","按一级标题","按二级标题","按长度","按表格行"）
+        chunk_size: 每个chunk的目标长度，默认600
+        chunk_overlap: chunk间的重叠长度，默认100
+        length_unit: 长度单位，"char" 按字符数（默认），"token" 按分词器 token 数
     Returns:
         分块后的文档列表
     """
+    by_token = length_unit == LENGTH_UNIT_TOKEN
 
     # 验证参数：确保chunk_overlap小于chunk_size
     if chunk_overlap >= chunk_size:
         # 如果overlap大于等于size，则将其设置为size的一半或一个较小的值
         chunk_overlap = chunk_size // 2 if chunk_size > 1 else 0
 
+    if chunk_setting == "custom" and sentence_identifier == ROW_PACKING_IDENTIFIER:
+        # 表格行打包：连续行合并为一个文档块，非表格文档按默认规则切分
+        # documents 可能是表格文件的惰性生成器，只遍历一次
+        row_documents, other_documents = [], []
+        for doc in documents:
+            (row_documents if 'row' in doc.metadata else other_documents).append(doc)
+        if by_token:
+            lengths = count_tokens([doc.page_content for doc in row_documents])
+            text_splitter = TokenTextSplitter(chunk_size, chunk_overlap)
+        else:
+            lengths = None
+            text_splitter = RecursiveCharacterTextSplitter(
+                chunk_size=chunk_size,
+                chunk_overlap=chunk_overlap,
+            )
+        return pack_table_rows(row_documents, chunk_size, lengths) + text_splitter.split_documents(other_documents)
+
     if chunk_setting == "default":
+        if by_token:
+            return TokenTextSplitter(chunk_size, chunk_overlap).split_documents(documents)
         # 使用默认的递归字符切分器
         text_splitter = RecursiveCharacterTextSplitter(
             chunk_size=chunk_size,
@@ -32,31 +62,70 @@ def chunk_documents(documents, chunk_setting, chunk_size, chunk_overlap,
     elif chunk_setting == "custom":
         # 根据分隔符类型选择不同的处理方式
         if sentence_identifier == "按页面":
-            text_splitter = CharacterTextSplitter(
-                separator="\f",
-                chunk_size=chunk_size,
-                chunk_overlap=chunk_overlap
-            )
+            separator = "\f"
         elif sentence_identifier == "按一级标题":
-            text_splitter = CharacterTextSplitter(
-                separator="\n# ",
-                chunk_size=chunk_size,
-                chunk_overlap=chunk_overlap
-            )
+            separator = "\n# "
         elif sentence_identifier == "按二级标题":
-            text_splitter = CharacterTextSplitter(
-                separator="\n## ",
-                chunk_size=chunk_size,
-                chunk_overlap=chunk_overlap
-            )
+            separator = "\n## "
         else:
             # 按长度或其他自定义分隔符
-            text_splitter = CharacterTextSplitter(
-                chunk_size=chunk_size,
-                chunk_overlap=chunk_overlap
-            )
+            separator = "\n\n"
+
+        if by_token:
+            return TokenTextSplitter(chunk_size, chunk_overlap, separator=separator).split_documents(documents)
+        text_splitter = CharacterTextSplitter(
+            separator=separator,
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap
+        )
     else:
         raise ValueError(f"Unsupported chunk setting: {chunk_setting}")
 
     split_documents = text_splitter.split_documents(documents)
     return split_documents
+
+
+def pack_table_rows(documents, chunk_size, lengths=None):
+    """
+    将同一工作表中连续的表格行打包为文档块
+    每个文档块以表头开头，随后逐行追加，直到长度达到 chunk_size；单行超长时单独成块
+    Args:
+        documents: 表格行文档（metadata 中包含 row，可选 sheet / columns）
+        chunk_size: 每个文档块的目标长度
+        lengths: 每行的长度（如 token 数），默认按字符数计算
+    Returns:
+        打包后的文档列表，metadata 中记录 row_start / row_end 以便引用原始行
+    """
+    packed = []
+    rows = []
+    length = 0
+    current_key = None
+
+    def flush():
+        if not rows:
+            return
+        first = rows[0].metadata
+        header = f"表头: {first['columns']}\n" if first.get('columns') else ""
+        metadata = {k: v for k, v in first.items() if k not in ('row', 'columns')}
+        metadata['row_start'] = first['row']
+        metadata['row_end'] = rows[-1].metadata['row']
+        packed.append(Document(
+            page_content=header + "\n".join(doc.page_content for doc in rows),
+            metadata=metadata
+        ))
+
+    for i, doc in enumerate(documents):
+        key = (doc.metadata.get('source'), doc.metadata.get('sheet'), doc.metadata.get('columns'))
+        row_length = (lengths[i] if lengths is not None else len(doc.page_content)) + 1
+        if rows and (key != current_key or length + row_length > chunk_size):
+            flush()
+            rows = []
+            length = 0
+        if not rows:
+            current_key = key
+            length = len(doc.metadata.get('columns') or "") + 4
+        rows.append(doc)
+        length += row_length
+    flush()
+
+    return packed
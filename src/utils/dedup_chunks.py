@@ -0,0 +1,115 @@
+# src/utils/dedup_chunks.py
+import os
+import re
+import zlib
+
+import numpy as np
+
+# 默认相似度阈值（估计 Jaccard 相似度不低于该值视为近似重复），不大于 0 时关闭去重
+# 默认关闭，由知识库的 dedup_threshold（如 0.9）或该环境变量开启，避免改变已有知识库的构建结果
+DEDUP_THRESHOLD = float(os.environ.get("KBS_DEDUP_THRESHOLD", 0))
+# MinHash 签名长度
+DEDUP_NUM_PERM = 128
+# 字符 shingle 长度，按字符切分对中文和英文都适用
+DEDUP_SHINGLE_SIZE = 5
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+_WHITESPACE = re.compile(r'\s+')
+
+# 固定种子，保证同一文本在不同构建中的签名一致
+_rng = np.random.RandomState(1)
+_PERM_A = _rng.randint(1, (1 << 61) - 1, size=DEDUP_NUM_PERM, dtype=np.uint64)
+_PERM_B = _rng.randint(0, (1 << 61) - 1, size=DEDUP_NUM_PERM, dtype=np.uint64)
+
+
+def _shingles(text):
+    """
+    文本归一化后切成字符 shingle，并用 crc32 映射为 32 位整数
+    """
+    text = _WHITESPACE.sub(" ", text).strip().lower()
+    if len(text) <= DEDUP_SHINGLE_SIZE:
+        grams = {text}
+    else:
+        grams = {text[i:i + DEDUP_SHINGLE_SIZE] for i in range(len(text) - DEDUP_SHINGLE_SIZE + 1)}
+    return np.fromiter((zlib.crc32(g.encode('utf-8')) for g in grams), dtype=np.uint64, count=len(grams))
+
+
+def minhash_signature(text):
+    """
+    计算文本的 MinHash 签名
+    :param text: 文本
+    :return: 长度为 DEDUP_NUM_PERM 的 uint64 数组
+    """
+    hashes = _shingles(text)
+    # (a * x + b) mod p，结果截断到 32 位；每一列对应一个置换
+    with np.errstate(over='ignore'):
+        permuted = (np.outer(hashes, _PERM_A) + _PERM_B) % _MERSENNE_PRIME & _MAX_HASH
+    return permuted.min(axis=0)
+
+
+def _bands_for_threshold(threshold, num_perm=DEDUP_NUM_PERM):
+    """
+    选择 LSH 分段数 b 和每段行数 r（b * r = num_perm），
+    使候选阈值 (1/b)^(1/r) 最接近相似度阈值
+    """
+    best = None
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows:
+            continue
+        bands = num_perm // rows
+        approx = (1.0 / bands) ** (1.0 / rows)
+        if best is None or abs(approx - threshold) < best[0]:
+            best = (abs(approx - threshold), bands, rows)
+    return best[1], best[2]
+
+
+def dedup_documents(documents, threshold=None):
+    """
+    基于 MinHash/LSH 去除近似重复的文档块（页眉页脚、免责声明、重复的条款等）
+    只在同一文件（source_url）内去重，按顺序保留每组近似重复中的第一个文档块：
+    跨文件去重后，移除保留副本所在的文件会连带删除其他文件的内容。
+    表格行文档块（元数据含 row / row_start）内容相近但代表不同记录，不参与去重。
+    Args:
+        documents: 分块后的文档列表
+        threshold: 相似度阈值，默认 DEDUP_THRESHOLD，不大于 0 时不去重
+    Returns:
+        (documents, dropped): 去重后的文档列表，以及被去除的文档块数量
+    """
+    threshold = DEDUP_THRESHOLD if threshold is None else float(threshold)
+    if threshold <= 0 or len(documents) < 2:
+        return list(documents), 0
+    threshold = min(threshold, 1.0)
+
+    bands, rows = _bands_for_threshold(threshold)
+    # source_url -> (LSH 分段桶, 已保留文档块的签名)
+    per_source = {}
+    kept = []
+    dropped = 0
+
+    for doc in documents:
+        if 'row' in doc.metadata or 'row_start' in doc.metadata or not doc.page_content.strip():
+            kept.append(doc)
+            continue
+
+        buckets, signatures = per_source.setdefault(doc.metadata.get('source_url'),
+                                                    ([{} for _ in range(bands)], []))
+        signature = minhash_signature(doc.page_content)
+        keys = [signature[b * rows:(b + 1) * rows].tobytes() for b in range(bands)]
+
+        # LSH 找出候选，再用签名估计的 Jaccard 相似度确认
+        candidates = set()
+        for band, key in zip(buckets, keys):
+            candidates.update(band.get(key, ()))
+        if any(np.mean(signatures[c] == signature) >= threshold for c in candidates):
+            dropped += 1
+            continue
+
+        position = len(signatures)
+        signatures.append(signature)
+        for band, key in zip(buckets, keys):
+            band.setdefault(key, []).append(position)
+        kept.append(doc)
+
+    print(f"近似重复去除: {len(documents)} 个文档块中去除 {dropped} 个（阈值 {threshold}）")
+    return kept, dropped
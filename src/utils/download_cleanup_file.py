@@ -2,39 +2,119 @@ import requests
 import tempfile
 import os
 import logging
+import threading
 from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-def download_file(url):
+# 每次写入临时文件的块大小（字节）
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# 单个文件的大小上限（字节）
+DOWNLOAD_MAX_BYTES = int(os.environ.get("KBS_DOWNLOAD_MAX_BYTES", 1024 ** 3))
+# 连接中断后通过 Range 续传的最大次数
+DOWNLOAD_MAX_RESUMES = 3
+# 连接超时 / 读取超时（秒）
+DOWNLOAD_TIMEOUT = (10, 60)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class FileTooLargeError(Exception):
+    """下载的文件超过大小上限"""
+
+
+def get_session():
+    """
+    获取复用连接池的全局 requests.Session
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504],
+                              allowed_methods=["GET"])
+                adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=retry)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _session = session
+    return _session
+
+
+def download_file(url, max_bytes=None):
     """
     下载文件并保存到临时路径
+    以固定大小的块流式写入临时文件，内存占用与文件大小无关；连接中断时通过 Range 续传
     Args:
         url (str): 文件URL
+        max_bytes (int): 文件大小上限，默认 DOWNLOAD_MAX_BYTES
     Returns:
         str: 临时文件路径
     Raises:
         Exception: 下载或保存失败时抛出异常
     """
+    max_bytes = max_bytes or DOWNLOAD_MAX_BYTES
+
+    # 获取文件扩展名
+    parsed_url = urlparse(url)
+    filename = os.path.basename(parsed_url.path)
+    extension = os.path.splitext(filename)[1] if os.path.splitext(filename)[1] else '.tmp'
+
+    # 创建临时文件
+    tmpfile = tempfile.NamedTemporaryFile(delete=False, suffix=extension)
     try:
         logging.info(f"开始下载文件: {url}")
-        response = requests.get(url, timeout=30)
-        response.raise_for_status()
+        session = get_session()
+        written = 0
+        resumes = 0
+
+        while True:
+            # 续传依赖字节偏移，禁止压缩传输
+            headers = {"Accept-Encoding": "identity"}
+            if written:
+                headers["Range"] = f"bytes={written}-"
+            try:
+                with session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT, headers=headers) as response:
+                    response.raise_for_status()
+
+                    if written and response.status_code != 206:
+                        # 服务端不支持断点续传，从头下载
+                        tmpfile.seek(0)
+                        tmpfile.truncate()
+                        written = 0
+
+                    content_length = response.headers.get("Content-Length")
+                    if content_length and content_length.isdigit() and written + int(content_length) > max_bytes:
+                        raise FileTooLargeError(f"文件大小超过上限 {max_bytes} 字节")
 
-        # 获取文件扩展名
-        parsed_url = urlparse(url)
-        filename = os.path.basename(parsed_url.path)
-        extension = os.path.splitext(filename)[1] if os.path.splitext(filename)[1] else '.tmp'
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        if not chunk:
+                            continue
+                        written += len(chunk)
+                        if written > max_bytes:
+                            raise FileTooLargeError(f"文件大小超过上限 {max_bytes} 字节")
+                        tmpfile.write(chunk)
+                break
+            except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+                resumes += 1
+                if resumes > DOWNLOAD_MAX_RESUMES:
+                    raise
+                logging.warning(f"下载连接中断，从第 {written} 字节续传（第 {resumes} 次）: {str(e)}")
 
-        # 创建临时文件
-        with tempfile.NamedTemporaryFile(delete=False, suffix=extension) as tmpfile:
-            tmpfile.write(response.content)
-            logging.info(f"文件下载完成，保存路径: {tmpfile.name}")
-            return tmpfile.name
+        tmpfile.close()
+        logging.info(f"文件下载完成，保存路径: {tmpfile.name}，大小 {written} 字节")
+        return tmpfile.name
 
-    except requests.RequestException as e:
+    except (requests.RequestException, FileTooLargeError) as e:
+        tmpfile.close()
+        cleanup_temp_file(tmpfile.name)
         error_msg = f"下载文件失败: {str(e)}"
         logging.error(error_msg)
         raise Exception(error_msg)
     except Exception as e:
+        tmpfile.close()
+        cleanup_temp_file(tmpfile.name)
         error_msg = f"保存文件失败: {str(e)}"
         logging.error(error_msg)
         raise Exception(error_msg)
@@ -0,0 +1,178 @@
+# src/utils/embedding_cache.py
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+# 缓存文件路径
+EMBEDDING_CACHE_PATH = os.environ.get("KBS_EMBEDDING_CACHE_PATH", os.path.join("vectorstores", "embedding_cache.sqlite3"))
+# 缓存向量总大小上限（字节），超过后按最近访问时间淘汰
+EMBEDDING_CACHE_MAX_BYTES = int(os.environ.get("KBS_EMBEDDING_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+# 淘汰后保留的比例，避免每次写入都触发淘汰
+EVICT_TARGET_RATIO = 0.9
+# SQLite 单条语句的参数个数上限
+_SQL_BATCH = 500
+
+
+def text_hash(text):
+    """
+    计算文档块文本的 sha256
+    """
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    基于内容寻址的持久化 Embedding 缓存
+    键为 (Embedding 模型, 文本 sha256)，值为 float32 向量，按大小进行 LRU 淘汰。
+    """
+
+    def __init__(self, path=EMBEDDING_CACHE_PATH, max_bytes=EMBEDDING_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embedding_cache ("
+            "model TEXT NOT NULL, text_hash TEXT NOT NULL, vector BLOB NOT NULL, "
+            "size INTEGER NOT NULL, last_access REAL NOT NULL, "
+            "PRIMARY KEY (model, text_hash))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embedding_cache_access ON embedding_cache (last_access)")
+        self._conn.commit()
+
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM embedding_cache").fetchone()[0]
+        if self._total_bytes > self.max_bytes:
+            self._evict()
+
+    def get_many(self, model, hashes):
+        """
+        批量查询向量
+        :param model: Embedding 模型名称
+        :param hashes: 文本 sha256 列表
+        :return: dict，text_hash -> 向量(list)，未命中的不包含在内
+        """
+        found = {}
+        now = time.time()
+        with self._lock:
+            for start in range(0, len(hashes), _SQL_BATCH):
+                batch = hashes[start:start + _SQL_BATCH]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embedding_cache WHERE model = ? AND text_hash IN ({placeholders})",
+                    [model, *batch]
+                ).fetchall()
+                for h, blob in rows:
+                    found[h] = np.frombuffer(blob, dtype=np.float32).tolist()
+
+                if rows:
+                    self._conn.execute(
+                        f"UPDATE embedding_cache SET last_access = ? WHERE model = ? AND text_hash IN "
+                        f"({','.join('?' * len(rows))})",
+                        [now, model, *[h for h, _ in rows]]
+                    )
+            self._conn.commit()
+
+            self.hits += len(found)
+            self.misses += len(hashes) - len(found)
+        return found
+
+    def put_many(self, model, items):
+        """
+        批量写入向量
+        :param model: Embedding 模型名称
+        :param items: dict，text_hash -> 向量
+        """
+        if not items:
+            return
+        now = time.time()
+        rows = []
+        for h, vector in items.items():
+            blob = np.asarray(vector, dtype=np.float32).tobytes()
+            rows.append((model, h, blob, len(blob), now))
+
+        with self._lock:
+            for _, h, _, size, _ in rows:
+                existing = self._conn.execute(
+                    "SELECT size FROM embedding_cache WHERE model = ? AND text_hash = ?", (model, h)
+                ).fetchone()
+                self._total_bytes += size - (existing[0] if existing else 0)
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embedding_cache (model, text_hash, vector, size, last_access) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+            self._conn.commit()
+
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """
+        按最近访问时间淘汰，直到总大小低于上限的 EVICT_TARGET_RATIO
+        """
+        target = int(self.max_bytes * EVICT_TARGET_RATIO)
+        evicted = 0
+        while self._total_bytes > target:
+            rows = self._conn.execute(
+                "SELECT rowid, size FROM embedding_cache ORDER BY last_access LIMIT 1000"
+            ).fetchall()
+            if not rows:
+                self._total_bytes = 0
+                break
+
+            rowids = []
+            for rowid, size in rows:
+                rowids.append(rowid)
+                self._total_bytes -= size
+                if self._total_bytes <= target:
+                    break
+            self._conn.execute(f"DELETE FROM embedding_cache WHERE rowid IN ({','.join('?' * len(rowids))})", rowids)
+            evicted += len(rowids)
+        self._conn.commit()
+        logging.info(f"Embedding缓存淘汰 {evicted} 条，当前大小 {self._total_bytes} 字节")
+
+    def stats(self):
+        """
+        缓存命中统计
+        """
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM embedding_cache").fetchone()[0]
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "entries": entries,
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes
+            }
+
+
+_embedding_cache = None
+_embedding_cache_lock = threading.Lock()
+
+
+def get_embedding_cache():
+    """
+    获取全局 Embedding 缓存（首次使用时创建）
+    """
+    global _embedding_cache
+    if _embedding_cache is None:
+        with _embedding_cache_lock:
+            if _embedding_cache is None:
+                _embedding_cache = EmbeddingCache()
+    return _embedding_cache
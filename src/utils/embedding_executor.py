@@ -0,0 +1,180 @@
+# src/utils/embedding_executor.py
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from langchain_community.embeddings.dashscope import DashScopeEmbeddings, embed_with_retry
+
+# 并发请求数
+EMBED_CONCURRENCY = int(os.environ.get("KBS_EMBED_CONCURRENCY", 4))
+# 每秒最多发起的请求数（令牌桶速率）
+EMBED_REQUESTS_PER_SECOND = float(os.environ.get("KBS_EMBED_RPS", 10))
+# 单批最大重试次数
+EMBED_MAX_RETRIES = int(os.environ.get("KBS_EMBED_MAX_RETRIES", 5))
+# 指数退避的初始等待和最大等待（秒）
+EMBED_BACKOFF_BASE = 1.0
+EMBED_BACKOFF_MAX = 30.0
+
+# 各模型单次请求的文本条数上限，未列出的模型按 25 条处理
+PROVIDER_BATCH_LIMITS = {
+    "text-embedding-v3": 10,
+}
+DEFAULT_PROVIDER_BATCH_LIMIT = 25
+
+
+def provider_batch_limit(model):
+    """
+    获取模型单次请求的文本条数上限
+    """
+    return PROVIDER_BATCH_LIMITS.get(model, DEFAULT_PROVIDER_BATCH_LIMIT)
+
+
+def _is_throttled(error):
+    message = str(error)
+    return "429" in message or "Throttling" in message or "rate limit" in message.lower()
+
+
+def _is_retryable(error):
+    # DashScope 对 400/401 抛出 ValueError，重试无意义；限流总是可以重试
+    return _is_throttled(error) or not isinstance(error, ValueError)
+
+
+class TokenBucket:
+    """
+    线程安全的令牌桶，用于限制请求速率
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = max(rate, 0.001)
+        self.capacity = capacity if capacity is not None else max(1.0, self.rate)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        获取一个令牌，没有令牌时阻塞等待
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                else:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                    self._last = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        被服务端限流时暂停所有请求一段时间
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+
+class EmbeddingExecutor:
+    """
+    批量、并发、限流感知的 Embedding 执行器
+    按服务端上限分批，N 个批次并行请求，令牌桶限流，单批指数退避重试。
+    text_type 为 "query" 时按查询类型向量化（与 embed_query 一致），用于批量检索；默认按文档类型。
+    """
+
+    def __init__(self, embeddings, batch_size=None, concurrency=EMBED_CONCURRENCY,
+                 requests_per_second=EMBED_REQUESTS_PER_SECOND, max_retries=EMBED_MAX_RETRIES,
+                 text_type="document"):
+        model = getattr(embeddings, 'model', None)
+        limit = provider_batch_limit(model)
+        if isinstance(embeddings, DashScopeEmbeddings) and embeddings.max_retries != 1:
+            # DashScopeEmbeddings 内部的 tenacity 重试（含 429）绕过令牌桶和 pause，且与下面的重试叠加，
+            # 这里只请求一次，重试和退避统一由执行器处理（不修改调用方共享的对象）
+            embeddings = embeddings.copy(update={"max_retries": 1})
+        self.embeddings = embeddings
+        self.batch_size = min(batch_size or limit, limit)
+        self.concurrency = max(1, concurrency)
+        self.max_retries = max_retries
+        self.bucket = TokenBucket(requests_per_second)
+        self.text_type = text_type
+        self._retries_lock = threading.Lock()
+        self.last_stats = {}
+
+    def embed(self, texts, progress_callback=None, on_batch=None):
+        """
+        向量化文本列表
+        Args:
+            texts: 文本列表
+            progress_callback: 每完成一批调用 progress_callback(done, total)，可抛出异常以中止
+            on_batch: 每完成一批调用 on_batch(start, vectors)，例如写入缓存
+        Returns:
+            list: 与 texts 一一对应的向量
+        """
+        started = time.monotonic()
+        results = [None] * len(texts)
+        batches = [(start, texts[start:start + self.batch_size]) for start in range(0, len(texts), self.batch_size)]
+        self._retries = 0
+        done = 0
+
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            futures = {executor.submit(self._embed_batch, batch): (start, len(batch)) for start, batch in batches}
+            for future in as_completed(futures):
+                start, size = futures[future]
+                vectors = future.result()
+                results[start:start + size] = vectors
+                done += size
+                if on_batch is not None:
+                    on_batch(start, vectors)
+                if progress_callback is not None:
+                    progress_callback(done, len(texts))
+        finally:
+            # 出错或被取消时不再发起尚未开始的批次
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        elapsed = time.monotonic() - started
+        self.last_stats = {
+            "chunks": len(texts),
+            "batches": len(batches),
+            "retries": self._retries,
+            "seconds": round(elapsed, 3),
+            "chunks_per_sec": round(len(texts) / elapsed, 2) if elapsed > 0 else 0.0
+        }
+        if texts:
+            print(f"Embedding完成: {len(texts)} 个文本，{len(batches)} 批，重试 {self._retries} 次，"
+                  f"耗时 {elapsed:.2f}s，吞吐 {self.last_stats['chunks_per_sec']} chunks/s")
+        return results
+
+    def _embed_batch(self, texts):
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            try:
+                return self._request(texts)
+            except Exception as e:
+                if attempt >= self.max_retries or not _is_retryable(e):
+                    raise
+                delay = min(EMBED_BACKOFF_MAX, EMBED_BACKOFF_BASE * 2 ** attempt) * (0.5 + random.random() / 2)
+                if _is_throttled(e):
+                    # 被限流时所有并发请求一起退避
+                    self.bucket.pause(delay)
+                # 多个批次在工作线程中并发重试
+                with self._retries_lock:
+                    self._retries += 1
+                logging.warning(f"Embedding请求失败（第 {attempt + 1} 次），{delay:.1f}s 后重试: {str(e)}")
+                time.sleep(delay)
+
+    def _request(self, texts):
+        if self.text_type != "query":
+            return self.embeddings.embed_documents(texts)
+        if isinstance(self.embeddings, DashScopeEmbeddings):
+            # embed_documents 固定使用 text_type="document"，查询需按 "query" 类型批量请求
+            result = embed_with_retry(self.embeddings, input=texts, text_type="query", model=self.embeddings.model)
+            return [item["embedding"] for item in result]
+        return [self.embeddings.embed_query(text) for text in texts]
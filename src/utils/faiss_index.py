@@ -0,0 +1,225 @@
+# src/utils/faiss_index.py
+import json
+import logging
+import math
+import os
+import time
+
+import faiss
+import numpy as np
+
+# 支持的索引类型，auto 按文档块数量自动选择
+INDEX_TYPES = ("auto", "Flat", "IVF-Flat", "IVF-PQ", "HNSW")
+# 自动选择：少于该数量用精确的 Flat 索引
+AUTO_FLAT_MAX_VECTORS = 20000
+# 自动选择：少于该数量用 IVF-Flat，更多时用 IVF-PQ 压缩内存
+AUTO_IVF_FLAT_MAX_VECTORS = 1000000
+# 训练 IVF / PQ 时使用的最大样本数
+INDEX_TRAIN_SAMPLE = int(os.environ.get("KBS_INDEX_TRAIN_SAMPLE", 100000))
+# 构建时用于选择默认 nprobe / efSearch 的目标召回率
+INDEX_TARGET_RECALL = float(os.environ.get("KBS_INDEX_TARGET_RECALL", 0.95))
+# 召回率评测的查询数和 k
+BENCHMARK_QUERIES = 100
+BENCHMARK_K = 10
+
+# IVF 每个聚类中心至少需要的训练样本数
+_MIN_POINTS_PER_CENTROID = 39
+# PQ 每个子空间的编码位数及所需的最少训练样本数
+_PQ_NBITS = 8
+_PQ_MIN_TRAIN = 1 << _PQ_NBITS
+# PQ 子空间数上限
+_PQ_MAX_M = 64
+# HNSW 图的邻居数和构建时的搜索宽度
+_HNSW_M = 32
+_HNSW_EF_CONSTRUCTION = 200
+
+# 查询时可调整的参数
+SEARCH_PARAMS = ("nprobe", "efSearch")
+
+
+def choose_index_type(n_vectors):
+    """
+    根据文档块数量自动选择索引类型
+    """
+    if n_vectors < AUTO_FLAT_MAX_VECTORS:
+        return "Flat"
+    if n_vectors < AUTO_IVF_FLAT_MAX_VECTORS:
+        return "IVF-Flat"
+    return "IVF-PQ"
+
+
+def parse_index_params(index_params):
+    """
+    解析索引参数，兼容 JSON 字符串和 dict
+    """
+    if not index_params:
+        return {}
+    if isinstance(index_params, str):
+        try:
+            index_params = json.loads(index_params)
+        except ValueError:
+            logging.warning(f"索引参数不是合法的 JSON，已忽略: {index_params}")
+            return {}
+    return dict(index_params) if isinstance(index_params, dict) else {}
+
+
+def _pq_m(dimension, m=None):
+    """
+    选择 PQ 子空间数：不超过上限且能整除向量维度的最大值
+    """
+    m = int(m or _PQ_MAX_M)
+    for candidate in range(min(m, dimension), 0, -1):
+        if dimension % candidate == 0:
+            return candidate
+    return 1
+
+
+def build_index(vectors, index_type="auto", index_params=None):
+    """
+    按索引类型创建并训练 FAISS 索引（不添加向量）
+    Args:
+        vectors: float32 向量矩阵 (n, d)
+        index_type: 索引类型，见 INDEX_TYPES
+        index_params: 构建参数（nlist、m、M、efConstruction），未指定时自动计算
+    Returns:
+        (index, index_type, index_params): 实际使用的索引类型和参数
+    """
+    n, dimension = vectors.shape
+    params = parse_index_params(index_params)
+    if not index_type or index_type == "auto":
+        index_type = choose_index_type(n)
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"不支持的索引类型: {index_type}，可选值: {', '.join(INDEX_TYPES)}")
+
+    if index_type in ("IVF-Flat", "IVF-PQ"):
+        # nlist 取 4√n，并保证每个聚类中心有足够的训练样本（训练只用 INDEX_TRAIN_SAMPLE 个样本）
+        max_nlist = min(n, INDEX_TRAIN_SAMPLE) // _MIN_POINTS_PER_CENTROID
+        nlist = min(int(params.get("nlist") or 4 * math.sqrt(n)), max_nlist)
+        if nlist < 2 or (index_type == "IVF-PQ" and min(n, INDEX_TRAIN_SAMPLE) < _PQ_MIN_TRAIN):
+            logging.warning(f"文档块数量 {n} 不足以训练 {index_type} 索引，改用 Flat")
+            index_type = "Flat"
+        else:
+            params["nlist"] = nlist
+
+    if index_type == "Flat":
+        return faiss.IndexFlatL2(dimension), index_type, {}
+
+    if index_type == "HNSW":
+        params["M"] = int(params.get("M") or _HNSW_M)
+        params["efConstruction"] = int(params.get("efConstruction") or _HNSW_EF_CONSTRUCTION)
+        index = faiss.IndexHNSWFlat(dimension, params["M"])
+        index.hnsw.efConstruction = params["efConstruction"]
+        return index, index_type, params
+
+    quantizer = faiss.IndexFlatL2(dimension)
+    if index_type == "IVF-Flat":
+        index = faiss.IndexIVFFlat(quantizer, dimension, params["nlist"])
+    else:
+        params["m"] = _pq_m(dimension, params.get("m"))
+        index = faiss.IndexIVFPQ(quantizer, dimension, params["nlist"], params["m"], _PQ_NBITS)
+
+    # 在样本上训练
+    started = time.perf_counter()
+    if n > INDEX_TRAIN_SAMPLE:
+        sample = vectors[np.random.RandomState(0).choice(n, INDEX_TRAIN_SAMPLE, replace=False)]
+    else:
+        sample = vectors
+    index.train(sample)
+    print(f"{index_type} 索引训练完成: {len(sample)} 个样本，nlist={params['nlist']}，"
+          f"耗时 {time.perf_counter() - started:.2f}s")
+    return index, index_type, params
+
+
+def apply_search_params(index, index_params):
+    """
+    设置查询时参数（IVF 的 nprobe、HNSW 的 efSearch），其他参数忽略
+    """
+    params = parse_index_params(index_params)
+    space = faiss.ParameterSpace()
+    for name in SEARCH_PARAMS:
+        if params.get(name):
+            try:
+                space.set_index_parameter(index, name, int(params[name]))
+            except RuntimeError:
+                # 参数不适用于该索引类型
+                pass
+
+
+def _candidate_values(index_type, index_params):
+    if index_type in ("IVF-Flat", "IVF-PQ"):
+        nlist = index_params["nlist"]
+        values = [v for v in (1, 2, 4, 8, 16, 32, 64, 128, 256, 512) if v < nlist] + [nlist]
+        return "nprobe", values
+    if index_type == "HNSW":
+        return "efSearch", [16, 32, 64, 128, 256, 512]
+    return None, [None]
+
+
+def benchmark_index(index, vectors, index_type, index_params):
+    """
+    评测索引的召回率与查询延迟，以精确搜索结果为基准
+    并选出达到 INDEX_TARGET_RECALL 的最小 nprobe / efSearch 作为默认查询参数
+    Returns:
+        list: 每个参数取值的 {"param", "value", "recall", "latency_ms"}
+    """
+    n = len(vectors)
+    if n == 0:
+        return []
+    k = min(BENCHMARK_K, n)
+    queries = vectors[np.random.RandomState(1).choice(n, min(BENCHMARK_QUERIES, n), replace=False)]
+
+    name, values = _candidate_values(index_type, index_params)
+    if name:
+        # 暴力计算精确结果，不额外复制一份向量
+        _, truth = faiss.knn(queries, vectors, k)
+    else:
+        _, truth = index.search(queries, k)
+
+    space = faiss.ParameterSpace()
+    report = []
+    chosen = None
+    for value in values:
+        if name:
+            space.set_index_parameter(index, name, value)
+        started = time.perf_counter()
+        _, found = index.search(queries, k)
+        latency = (time.perf_counter() - started) * 1000 / len(queries)
+        recall = float(np.mean([len(set(f) & set(t)) / k for f, t in zip(found, truth)]))
+        report.append({"param": name, "value": value, "recall": round(recall, 4), "latency_ms": round(latency, 4)})
+        if chosen is None and recall >= INDEX_TARGET_RECALL:
+            chosen = value
+
+    if name:
+        index_params[name] = chosen if chosen is not None else values[-1]
+        space.set_index_parameter(index, name, index_params[name])
+
+    print(f"{index_type} 索引召回率/延迟评测（recall@{k}）:")
+    for row in report:
+        label = f"{row['param']}={row['value']}" if row['param'] else "exact"
+        print(f"  {label:>14}  recall={row['recall']:.4f}  latency={row['latency_ms']:.4f}ms/query")
+    return report
+
+
+def rebuild_index(index, keep_positions):
+    """
+    用保留的向量重建索引，用于删除后不能压缩编号的索引类型（HNSW、IVF、PQ 等）
+    IVF 的 remove_ids 会保留原编号，与 index_to_docstore_id 的重新编号不一致，因此同样重建；
+    非 HNSW 索引克隆后清空再写入，保留已训练的聚类中心和量化器。
+    Args:
+        index: 原索引
+        keep_positions: 保留向量的位置（按新顺序）
+    Returns:
+        新索引
+    """
+    index = faiss.downcast_index(index)
+    vectors = index.reconstruct_n(0, index.ntotal)[keep_positions]
+    if isinstance(index, faiss.IndexHNSW):
+        new_index = faiss.IndexHNSWFlat(index.d, index.hnsw.nb_neighbors(1))
+        new_index.hnsw.efConstruction = index.hnsw.efConstruction
+        new_index.hnsw.efSearch = index.hnsw.efSearch
+    else:
+        new_index = faiss.clone_index(index)
+        new_index.reset()
+    if len(vectors):
+        new_index.add(vectors)
+    return new_index
@@ -0,0 +1,265 @@
+# src/utils/index_store.py
+import hashlib
+import json
+import logging
+import os
+import shutil
+from datetime import datetime
+
+import faiss
+from langchain_community.vectorstores import FAISS
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+from src.utils.faiss_index import apply_search_params
+from src.utils.sparse_index import BM25Index
+from src.utils.vectorize_documents import serialize_vectorstore, load_vectorstore, encode_docstore, decode_docstore
+
+# 新构建的索引保存位置：db 存入 LONGBLOB 列，local 存入本地目录（数据库只保存路径和版本）
+INDEX_STORE = os.environ.get("KBS_INDEX_STORE", "db")
+# 本地索引目录，多个工作进程需指向同一目录
+INDEX_STORE_DIR = os.environ.get("KBS_INDEX_STORE_DIR", os.path.join("vectorstores", "indexes"))
+# 加载时的校验方式：size 只校验文件大小（索引文件不必整体读入），full 校验 sha256
+INDEX_VERIFY = os.environ.get("KBS_INDEX_VERIFY", "size")
+
+INDEX_FILE = "index.faiss"
+DOCSTORE_FILE = "docstore.bin"
+SPARSE_FILE = "sparse.bin"
+MANIFEST_FILE = "manifest.json"
+
+# 优先使用可直接在映射内存上查询的 IO_FLAG_MMAP_IFC（faiss >= 1.9），否则使用 IO_FLAG_MMAP
+_MMAP_FLAG = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+# session.info 中记录尚未随事务提交的新版本目录
+_PENDING_INDEX_DIRS = "pending_index_dirs"
+
+
+class IndexChecksumError(Exception):
+    """本地索引文件校验失败"""
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _serialize_sparse(vectorstore):
+    sparse_index = getattr(vectorstore, 'sparse_index', None)
+    return sparse_index.serialize() if sparse_index is not None else None
+
+
+class DBIndexStore:
+    """
+    索引存储在 knowledge 表的 faiss_index_data / pkl_index_data / sparse_index_data 列
+    """
+    name = "db"
+
+    def save(self, kbs, vectorstore):
+        kbs.faiss_index_data, kbs.pkl_index_data = serialize_vectorstore(vectorstore)
+        kbs.sparse_index_data = _serialize_sparse(vectorstore)
+        kbs.index_size_bytes = (len(kbs.faiss_index_data) + len(kbs.pkl_index_data)
+                                + len(kbs.sparse_index_data or b''))
+        kbs.index_uri = None
+        kbs.index_version = (kbs.index_version or 0) + 1
+
+    def load(self, kbs, embeddings, mmap=True):
+        vectorstore = load_vectorstore(kbs.faiss_index_data, kbs.pkl_index_data, embeddings, kbs.index_params)
+        vectorstore.sparse_index = BM25Index.deserialize(kbs.sparse_index_data) if kbs.sparse_index_data else None
+        return vectorstore
+
+    def delete(self, kbs):
+        pass
+
+
+class LocalIndexStore:
+    """
+    索引存储在本地目录：<root>/kbs_<id>/v<version>/ 下的索引文件、docstore 和带 sha256 的 manifest
+    索引文件通过 mmap 加载，多个进程共享操作系统的页缓存
+    """
+    name = "local"
+
+    def __init__(self, root=INDEX_STORE_DIR):
+        self.root = root
+
+    def _kbs_dir(self, kbs):
+        return os.path.join(self.root, f"kbs_{kbs.id}")
+
+    def save(self, kbs, vectorstore):
+        version = (kbs.index_version or 0) + 1
+        relative = os.path.join(f"kbs_{kbs.id}", f"v{version}")
+        target = os.path.join(self.root, relative)
+        staging = target + ".tmp"
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+
+        faiss.write_index(vectorstore.index, os.path.join(staging, INDEX_FILE))
+        with open(os.path.join(staging, DOCSTORE_FILE), 'wb') as f:
+            f.write(encode_docstore(vectorstore.docstore, vectorstore.index_to_docstore_id))
+        files = [INDEX_FILE, DOCSTORE_FILE]
+        sparse_data = _serialize_sparse(vectorstore)
+        if sparse_data:
+            with open(os.path.join(staging, SPARSE_FILE), 'wb') as f:
+                f.write(sparse_data)
+            files.append(SPARSE_FILE)
+
+        manifest = {"version": version, "created_time": datetime.now().strftime('%Y-%m-%d %H:%M:%S'), "files": {}}
+        for name in files:
+            path = os.path.join(staging, name)
+            manifest["files"][name] = {"size": os.path.getsize(path), "sha256": _sha256(path)}
+        with open(os.path.join(staging, MANIFEST_FILE), 'w') as f:
+            json.dump(manifest, f)
+
+        # 写完后整体改名，读取方不会看到写了一半的版本
+        shutil.rmtree(target, ignore_errors=True)
+        os.rename(staging, target)
+
+        kbs.index_uri = relative
+        kbs.index_version = version
+        kbs.index_size_bytes = sum(f["size"] for f in manifest["files"].values())
+        kbs.faiss_index_data = None
+        kbs.pkl_index_data = None
+        kbs.sparse_index_data = None
+        self._cleanup(kbs, keep=(version, version - 1))
+        _discard_unless_committed(kbs, target)
+        print(f"知识库 {kbs.kon_name} 索引已保存到 {target}")
+
+    def _cleanup(self, kbs, keep):
+        """
+        删除旧版本，保留当前和上一个版本（其他进程可能仍在使用）
+        """
+        kbs_dir = self._kbs_dir(kbs)
+        for entry in os.listdir(kbs_dir):
+            if entry.startswith("v") and entry[1:].isdigit() and int(entry[1:]) not in keep:
+                shutil.rmtree(os.path.join(kbs_dir, entry), ignore_errors=True)
+
+    def _verify(self, directory):
+        """
+        校验 manifest 中的文件
+        Returns:
+            list: manifest 中的文件名
+        """
+        with open(os.path.join(directory, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+        for name, expected in manifest["files"].items():
+            path = os.path.join(directory, name)
+            if os.path.getsize(path) != expected["size"]:
+                raise IndexChecksumError(f"索引文件大小不一致: {path}")
+            # docstore 每次加载都要完整读取，顺便校验；索引文件仅在 full 模式下校验
+            if (name != INDEX_FILE or INDEX_VERIFY == "full") and _sha256(path) != expected["sha256"]:
+                raise IndexChecksumError(f"索引文件校验失败: {path}")
+        return list(manifest["files"])
+
+    def load(self, kbs, embeddings, mmap=True):
+        """
+        Args:
+            mmap: 是否以 mmap 方式加载。映射的索引是只读的，需要增删向量时传 False
+        """
+        directory = os.path.join(self.root, kbs.index_uri)
+        files = self._verify(directory)
+        docstore_file = next(name for name in files if name not in (INDEX_FILE, SPARSE_FILE))
+
+        index_path = os.path.join(directory, INDEX_FILE)
+        index = None
+        if mmap:
+            try:
+                index = faiss.read_index(index_path, _MMAP_FLAG)
+            except RuntimeError as e:
+                logging.warning(f"索引不支持 mmap 加载，改为读入内存: {str(e)}")
+        if index is None:
+            index = faiss.read_index(index_path)
+        apply_search_params(index, kbs.index_params)
+
+        with open(os.path.join(directory, docstore_file), 'rb') as f:
+            docstore, index_to_docstore_id = decode_docstore(f.read())
+        vectorstore = FAISS(embeddings, index, docstore, index_to_docstore_id)
+        vectorstore.sparse_index = None
+        if SPARSE_FILE in files:
+            with open(os.path.join(directory, SPARSE_FILE), 'rb') as f:
+                vectorstore.sparse_index = BM25Index.deserialize(f.read())
+        return vectorstore
+
+    def delete(self, kbs):
+        if kbs.id is not None:
+            shutil.rmtree(self._kbs_dir(kbs), ignore_errors=True)
+
+
+def _discard_unless_committed(kbs, directory):
+    """
+    新版本目录在数据库事务提交前写入，事务回滚（或未提交就关闭会话）时删除该目录，避免留下孤立的版本
+    """
+    session = object_session(kbs)
+    if session is not None:
+        session.info.setdefault(_PENDING_INDEX_DIRS, []).append(directory)
+
+
+@event.listens_for(Session, 'after_commit')
+def _keep_committed_index_dirs(session):
+    session.info.pop(_PENDING_INDEX_DIRS, None)
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def _discard_uncommitted_index_dirs(session, transaction):
+    if transaction.parent is not None:
+        return
+    for directory in session.info.pop(_PENDING_INDEX_DIRS, None) or []:
+        logging.warning(f"事务未提交，删除新写入的索引版本: {directory}")
+        shutil.rmtree(directory, ignore_errors=True)
+        try:
+            # 新建知识库回滚后，知识库目录为空
+            os.rmdir(os.path.dirname(directory))
+        except OSError:
+            pass
+
+
+INDEX_STORES = {
+    DBIndexStore.name: DBIndexStore,
+    LocalIndexStore.name: LocalIndexStore,
+}
+
+
+def get_index_store(name=None):
+    """
+    获取索引存储，默认使用 KBS_INDEX_STORE 配置的存储
+    """
+    name = name or INDEX_STORE
+    if name not in INDEX_STORES:
+        raise ValueError(f"不支持的索引存储: {name}，可选值: {', '.join(INDEX_STORES)}")
+    return INDEX_STORES[name]()
+
+
+def has_index(kbs):
+    """
+    知识库是否已有索引
+    """
+    return bool(kbs.index_uri) or bool(kbs.faiss_index_data and kbs.pkl_index_data)
+
+
+def save_index(kbs, vectorstore):
+    """
+    保存知识库索引到配置的存储，递增 index_version 并更新索引摘要（需由调用方提交事务）
+    """
+    previous = kbs.index_uri
+    get_index_store().save(kbs, vectorstore)
+    kbs.vector_count = vectorstore.index.ntotal
+    kbs.dimension = vectorstore.index.d
+    if previous and not kbs.index_uri:
+        # 从本地存储切换回数据库存储，清理本地文件
+        LocalIndexStore().delete(kbs)
+
+
+def load_index(kbs, embeddings, mmap=True):
+    """
+    加载知识库索引：有 index_uri 的从本地目录加载，否则从数据库列加载（兼容已有数据）
+    """
+    store = get_index_store(LocalIndexStore.name if kbs.index_uri else DBIndexStore.name)
+    return store.load(kbs, embeddings, mmap=mmap)
+
+
+def delete_index(kbs):
+    """
+    删除知识库的本地索引文件
+    """
+    if kbs.index_uri:
+        LocalIndexStore().delete(kbs)
@@ -0,0 +1,130 @@
+# src/utils/ingest_pipeline.py
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from src.utils.chunk_documents import chunk_documents
+from src.utils.download_cleanup_file import download_file, cleanup_temp_file
+from src.utils.load_document import load_document
+
+# 下载线程数（I/O 密集）
+DOWNLOAD_WORKERS = int(os.environ.get("KBS_DOWNLOAD_WORKERS", 8))
+# 解析进程数（CPU 密集：PDF / DOCX / Excel）
+PARSE_WORKERS = int(os.environ.get("KBS_PARSE_WORKERS", max(1, (os.cpu_count() or 2) - 1)))
+# 解析进程以 spawn 方式启动：Flask 进程中有任务、预热和检索线程，fork 时若其他线程持有锁（FAISS、SQLAlchemy、logging）子进程会死锁
+PARSE_MP_CONTEXT = multiprocessing.get_context("spawn")
+
+
+def _parse_file(temp_file_path, excel_header_processing, chunk_options):
+    """
+    在子进程中解析并分块文件（必须是模块级函数才能被 pickle）
+    表格文件的逐行文档由惰性生成器直接送入分块，只有分块结果传回主进程
+    """
+    if not os.path.exists(temp_file_path):
+        raise FileNotFoundError(f"下载的文件不存在: {temp_file_path}")
+    return chunk_documents(load_document(temp_file_path, excel_header_processing), **chunk_options)
+
+
+def ingest_files(file_list, excel_header_processing, chunk_setting, chunk_size, chunk_overlap,
+                 sentence_identifier, length_unit="char", download_workers=None, parse_workers=None,
+                 progress_callback=None, cancel_event=None):
+    """
+    并行下载、解析并分块文件列表
+    下载在线程池中执行，解析和分块在进程池中执行，只有分块结果传回主进程。
+    同时在途的文件数有上限，避免临时文件无限堆积。
+    Args:
+        file_list: 文件 URL 列表
+        excel_header_processing: 是否对表格文件进行表头处理
+        chunk_setting: 切分规则（"default", "custom"）
+        chunk_size: 每个chunk的目标长度
+        chunk_overlap: chunk间的重叠长度
+        sentence_identifier: 切分标识
+        length_unit: 分块长度单位（"char" / "token"）
+        download_workers: 下载线程数，默认 DOWNLOAD_WORKERS
+        parse_workers: 解析进程数，默认 PARSE_WORKERS
+        progress_callback: 每处理完一个文件调用 progress_callback(files_done, files_total)
+        cancel_event: threading.Event，置位后不再提交新文件，等待在途文件结束后返回
+    Returns:
+        (documents, failed_files): 按 file_list 顺序拼接的文档块列表，以及失败文件列表
+        [{"file": url, "error": 错误信息}]
+    """
+    download_workers = max(1, int(download_workers or DOWNLOAD_WORKERS))
+    parse_workers = max(1, int(parse_workers or PARSE_WORKERS))
+    max_inflight = download_workers + parse_workers
+
+    chunk_options = {
+        "chunk_setting": chunk_setting,
+        "chunk_size": chunk_size,
+        "chunk_overlap": chunk_overlap,
+        "sentence_identifier": sentence_identifier,
+        "length_unit": length_unit
+    }
+    results = [None] * len(file_list)
+    errors = {}
+    download_futures = {}
+    parse_futures = {}
+    next_index = 0
+    files_done = 0
+
+    with ThreadPoolExecutor(max_workers=download_workers) as download_pool, \
+            ProcessPoolExecutor(max_workers=parse_workers, mp_context=PARSE_MP_CONTEXT) as parse_pool:
+
+        def fill_window():
+            nonlocal next_index
+            if cancel_event is not None and cancel_event.is_set():
+                return
+            while next_index < len(file_list) and len(download_futures) + len(parse_futures) < max_inflight:
+                future = download_pool.submit(download_file, file_list[next_index])
+                download_futures[future] = next_index
+                next_index += 1
+
+        fill_window()
+
+        while download_futures or parse_futures:
+            done, _ = wait(list(download_futures) + list(parse_futures), return_when=FIRST_COMPLETED)
+
+            for future in done:
+                if future in download_futures:
+                    i = download_futures.pop(future)
+                    try:
+                        temp_file_path = future.result()
+                        parse_future = parse_pool.submit(_parse_file, temp_file_path, excel_header_processing,
+                                                         chunk_options)
+                        parse_futures[parse_future] = (i, temp_file_path)
+                    except Exception as e:
+                        errors[i] = str(e)
+                        files_done += 1
+                        logging.error(f"下载文件 {file_list[i]} 失败: {str(e)}")
+                    continue
+
+                i, temp_file_path = parse_futures.pop(future)
+                try:
+                    results[i] = future.result()
+                    # 记录每个文档块的来源文件，用于增量删除
+                    for doc in results[i]:
+                        doc.metadata['source_url'] = file_list[i]
+                    print(f"文件 {file_list[i]} 分块完成，共 {len(results[i])} 个文档块")
+                except Exception as e:
+                    errors[i] = str(e)
+                    logging.error(f"处理文件 {file_list[i]} 失败: {str(e)}")
+                finally:
+                    files_done += 1
+                    # 清理临时文件
+                    try:
+                        cleanup_temp_file(temp_file_path)
+                    except Exception as cleanup_error:
+                        logging.warning(f"清理临时文件时出错: {cleanup_error}")
+
+            if progress_callback is not None:
+                progress_callback(files_done, len(file_list))
+            fill_window()
+
+    # 按原始顺序拼接，保证输出与完成顺序无关
+    all_documents = []
+    for chunked_documents in results:
+        if chunked_documents:
+            all_documents.extend(chunked_documents)
+
+    failed_files = [{"file": file_list[i], "error": errors[i]} for i in sorted(errors)]
+    return all_documents, failed_files
@@ -0,0 +1,202 @@
+# src/utils/kbs_builder.py
+import json
+from datetime import datetime
+
+from database.database import db
+from src.pojo.KBSconstruction_pojo import KBSconstruction_pojo
+from src.utils.dedup_chunks import dedup_documents
+from src.utils.index_store import has_index, save_index, load_index
+from src.utils.ingest_pipeline import ingest_files
+from src.utils.sparse_index import build_sparse_index
+from src.utils.vectorize_documents import (
+    vectorize_documents,
+    get_embeddings,
+    add_documents_to_vectorstore,
+    delete_documents_by_source
+)
+
+
+class KBSBuildCancelled(Exception):
+    """知识库构建任务被取消"""
+
+
+class KBSFileUpdateError(Exception):
+    """增量更新请求无法执行，如要移除的文件在索引中没有文档块"""
+
+
+def build_kbs(data, progress_callback=None, cancel_event=None):
+    """
+    构建知识库：下载解析分块 -> 向量化 -> 保存索引并存入数据库
+    Args:
+        data: /addKBS 的请求体
+        progress_callback: 进度回调，progress_callback(stage=..., files_done=..., files_total=...,
+                           chunks_total=..., chunks_embedded=..., chunks_deduplicated=...)，参数均为可选关键字
+        cancel_event: threading.Event，置位后在下一个检查点终止构建
+    Returns:
+        list: 处理失败的文件列表
+    Raises:
+        KBSBuildCancelled: 构建被取消
+    """
+    def report(**kwargs):
+        if progress_callback is not None:
+            progress_callback(**kwargs)
+
+    def check_cancelled():
+        if cancel_event is not None and cancel_event.is_set():
+            raise KBSBuildCancelled("任务已取消")
+
+    file_list = parse_file_list(data.get('file_list'))
+    kon_name = data.get('kon_name')
+    emb_moddle = data.get('emb_moddle')
+
+    # 1. 并行下载、解析并分块所有文件（单个文件失败不影响其他文件）
+    report(stage='downloading', files_done=0, files_total=len(file_list))
+    all_documents, failed_files = ingest_files(
+        file_list,
+        data.get('excel_header_processing', False),
+        chunk_setting=data.get('chunk'),
+        chunk_size=data.get('estimated_length_per_senction'),
+        chunk_overlap=data.get('segmental_overlap_length'),
+        sentence_identifier=data.get('sentence_identifier'),
+        length_unit=data.get('chunk_length_unit') or 'char',
+        progress_callback=lambda done, total: report(files_done=done, files_total=total),
+        cancel_event=cancel_event
+    )
+    check_cancelled()
+
+    print(f"下载好文档，总共 {len(all_documents)} 个文档块")
+
+    # 去除近似重复的文档块，减少向量化成本和无效的 top-k 结果
+    all_documents, dropped = dedup_documents(all_documents, data.get('dedup_threshold'))
+    report(chunks_deduplicated=dropped)
+
+    # 检查是否有文档需要处理
+    if not all_documents:
+        raise ValueError(f"没有有效的文档内容可以处理，失败文件: {failed_files}")
+
+    # 2. 向量化文档
+    print("开始向量化文档")
+    report(stage='embedding', chunks_total=len(all_documents), chunks_embedded=0)
+
+    def on_embedded(done, total):
+        report(chunks_embedded=done, chunks_total=total)
+        check_cancelled()
+
+    try:
+        vectorstore, index_info = vectorize_documents(
+            all_documents, kon_name, emb_moddle, progress_callback=on_embedded,
+            index_type=data.get('index_type') or 'auto', index_params=data.get('index_params')
+        )
+    except Exception:
+        # vectorize_documents 会包装异常，这里还原取消状态
+        check_cancelled()
+        raise
+    print("向量化文档完成")
+
+    # 3. 存储 KBS 信息到数据库
+    report(stage='saving')
+    check_cancelled()
+
+    # 创建 data 的副本并序列化 file_list 为 JSON 字符串
+    data_to_store = data.copy()
+    data_to_store['file_list'] = json.dumps(file_list)
+
+    # 实际使用的索引类型、参数（含默认 nprobe / efSearch）和召回率/延迟评测
+    data_to_store['index_type'] = index_info['index_type']
+    data_to_store['index_params'] = json.dumps(index_info['index_params'])
+    data_to_store['index_report'] = json.dumps(index_info['index_report'])
+
+    new_kbs = KBSconstruction_pojo(**data_to_store)
+    db.session.add(new_kbs)
+    # 本地索引目录按知识库 id 命名，先 flush 获取 id
+    db.session.flush()
+    save_index(new_kbs, vectorstore)
+    db.session.commit()
+
+    return failed_files
+
+
+def parse_file_list(file_list):
+    """
+    解析文件列表，兼容 JSON 数组、逗号分隔字符串和列表
+    """
+    if not file_list:
+        return []
+    if isinstance(file_list, str):
+        try:
+            file_list = json.loads(file_list)
+        except ValueError:
+            pass
+    if isinstance(file_list, str):
+        file_list = file_list.split(',')
+    return [f.strip() for f in file_list if f and f.strip()]
+
+
+def update_kbs_files(kbs, add_files=None, remove_files=None):
+    """
+    增量更新知识库文件：只向量化新增文件的文档块并追加到已有索引，
+    按 source_url 元数据删除被移除文件的向量
+    Args:
+        kbs: KBSconstruction_pojo
+        add_files: 新增文件 URL 列表
+        remove_files: 移除文件 URL 列表
+    Returns:
+        dict: added_chunks / removed_chunks / deduplicated_chunks / failed_files / file_list
+    """
+    current_files = parse_file_list(kbs.file_list)
+    remove_set = set(parse_file_list(remove_files)) & set(current_files)
+    add_list = [f for f in dict.fromkeys(parse_file_list(add_files)) if f not in current_files or f in remove_set]
+
+    result = {"added_chunks": 0, "removed_chunks": 0, "deduplicated_chunks": 0, "failed_files": [],
+              "file_list": current_files}
+    if not remove_set and not add_list:
+        return result
+
+    if not has_index(kbs):
+        raise ValueError(f"知识库 {kbs.kon_name} 没有索引数据，无法增量更新")
+
+    embeddings = get_embeddings(kbs.emb_moddle)
+    # 需要增删向量，不能使用只读的 mmap 索引
+    vectorstore = load_index(kbs, embeddings, mmap=False)
+    if getattr(vectorstore, 'sparse_index', None) is None:
+        # 旧知识库没有稀疏索引，先根据已有文档构建
+        vectorstore.sparse_index = build_sparse_index(vectorstore)
+
+    # 1. 删除移除文件的向量
+    if remove_set:
+        # 添加 source_url 元数据之前构建的知识库无法按来源删除，拒绝移除而不是只从 file_list 中去掉
+        indexed_sources = {doc.metadata.get('source_url') for doc in vectorstore.docstore._dict.values()}
+        missing = sorted(f for f in remove_set if f not in indexed_sources)
+        if missing:
+            raise KBSFileUpdateError(f"索引中没有以下文件的文档块，无法移除（旧知识库需重新构建）: {', '.join(missing)}")
+        result["removed_chunks"] = delete_documents_by_source(vectorstore, remove_set)
+        print(f"知识库 {kbs.kon_name} 删除 {result['removed_chunks']} 个文档块")
+
+    # 2. 只处理新增文件
+    if add_list:
+        documents, failed_files = ingest_files(
+            add_list,
+            kbs.excel_header_processing,
+            chunk_setting=kbs.chunk,
+            chunk_size=kbs.estimated_length_per_senction,
+            chunk_overlap=kbs.segmental_overlap_length,
+            sentence_identifier=kbs.sentence_identifier,
+            length_unit=kbs.chunk_length_unit or 'char'
+        )
+        documents, result["deduplicated_chunks"] = dedup_documents(documents, kbs.dedup_threshold)
+        add_documents_to_vectorstore(vectorstore, documents, embeddings)
+        result["added_chunks"] = len(documents)
+        result["failed_files"] = failed_files
+        print(f"知识库 {kbs.kon_name} 新增 {len(documents)} 个文档块")
+
+    failed_set = {f["file"] for f in result["failed_files"]}
+    new_file_list = [f for f in current_files if f not in remove_set]
+    new_file_list += [f for f in add_list if f not in failed_set and f not in new_file_list]
+
+    save_index(kbs, vectorstore)
+    kbs.file_list = json.dumps(new_file_list)
+    kbs.update_time = datetime.now()
+    db.session.commit()
+
+    result["file_list"] = new_file_list
+    return result
@@ -0,0 +1,196 @@
+# src/utils/kbs_job_manager.py
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from database.database import db
+from src.pojo.kbs_job_pojo import KBSJobPojo
+from src.utils.kbs_builder import build_kbs, KBSBuildCancelled
+from src.utils.temporary_message.knowledge_warmup import knowledge_warmup
+
+# 后台构建线程数
+JOB_WORKERS = int(os.environ.get("KBS_JOB_WORKERS", 1))
+# 任务最多执行次数（服务重启后中断的任务会重新执行，超过次数则标记失败）
+MAX_JOB_ATTEMPTS = 2
+# 进度写库的最小间隔（秒），阶段切换时立即写库
+PROGRESS_FLUSH_INTERVAL = 1.0
+
+
+class KBSJobManager:
+    """
+    知识库构建任务管理器（本地进程内队列）
+    任务状态持久化在 kbs_job 表中，服务重启后会恢复排队中的任务，
+    中断的任务会重新执行或标记为失败。
+    """
+
+    def __init__(self, workers=JOB_WORKERS):
+        self.app = None
+        self.workers = max(1, workers)
+        self._queue = queue.Queue()
+        self._cancel_events = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """
+        绑定 Flask 应用并启动后台线程
+        """
+        if multiprocessing.current_process().name != "MainProcess":
+            # spawn 启动的解析子进程会重新导入主模块，子进程中不启动后台线程
+            return
+        with self._lock:
+            if self.app is not None:
+                return
+            self.app = app
+
+        threading.Thread(target=self._recover, name="kbs-job-recover", daemon=True).start()
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, name=f"kbs-job-worker-{i}", daemon=True).start()
+
+    def submit(self, data):
+        """
+        创建构建任务并加入队列（需在应用上下文中调用）
+        :param data: /addKBS 的请求体
+        :return: KBSJobPojo
+        """
+        job = KBSJobPojo(
+            job_id=uuid.uuid4().hex,
+            kon_name=data.get('kon_name'),
+            status='queued',
+            stage='queued',
+            payload=json.dumps(data, ensure_ascii=False),
+            files_total=len(data.get('file_list') or []),
+            files_done=0,
+            chunks_total=0,
+            chunks_embedded=0,
+            attempts=0
+        )
+        db.session.add(job)
+        db.session.commit()
+
+        self._queue.put(job.job_id)
+        return job
+
+    def cancel(self, job_id):
+        """
+        取消任务：排队中的任务直接标记为已取消，运行中的任务在下一个检查点终止
+        :return: KBSJobPojo，不存在时返回 None
+        """
+        job = db.session.get(KBSJobPojo, job_id)
+        if job is None:
+            return None
+
+        if job.status == 'queued':
+            job.status = 'cancelled'
+            job.finished_time = datetime.now()
+            db.session.commit()
+        elif job.status == 'running':
+            with self._lock:
+                event = self._cancel_events.get(job_id)
+            if event is not None:
+                event.set()
+        return job
+
+    def _recover(self):
+        """
+        恢复服务重启前未完成的任务
+        """
+        with self.app.app_context():
+            try:
+                jobs = KBSJobPojo.query.filter(
+                    KBSJobPojo.status.in_(['queued', 'running'])
+                ).order_by(KBSJobPojo.created_time).all()
+
+                for job in jobs:
+                    if job.status == 'running':
+                        if (job.attempts or 0) >= MAX_JOB_ATTEMPTS:
+                            job.status = 'failed'
+                            job.error = "服务重启导致任务中断，且已超过最大重试次数"
+                            job.finished_time = datetime.now()
+                            continue
+                        job.status = 'queued'
+                        job.stage = 'queued'
+                    self._queue.put(job.job_id)
+
+                db.session.commit()
+                if jobs:
+                    print(f"恢复了 {len(jobs)} 个未完成的知识库构建任务")
+            except Exception as e:
+                db.session.rollback()
+                logging.error(f"恢复知识库构建任务失败: {str(e)}", exc_info=True)
+
+    def _worker(self):
+        while True:
+            job_id = self._queue.get()
+            try:
+                with self.app.app_context():
+                    self._run(job_id)
+            except Exception as e:
+                logging.error(f"执行知识库构建任务 {job_id} 出错: {str(e)}", exc_info=True)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, job_id):
+        job = db.session.get(KBSJobPojo, job_id)
+        if job is None or job.status != 'queued':
+            return
+
+        event = threading.Event()
+        with self._lock:
+            self._cancel_events[job_id] = event
+
+        now = datetime.now()
+        job.status = 'running'
+        job.stage = 'downloading'
+        job.started_time = now
+        job.stage_started_time = now
+        job.attempts = (job.attempts or 0) + 1
+        job.error = None
+        db.session.commit()
+
+        last_flush = time.monotonic()
+
+        def on_progress(stage=None, **counters):
+            nonlocal last_flush
+            stage_changed = stage is not None and stage != job.stage
+            if stage_changed:
+                job.stage = stage
+                job.stage_started_time = datetime.now()
+            for key, value in counters.items():
+                setattr(job, key, value)
+            if stage_changed or time.monotonic() - last_flush >= PROGRESS_FLUSH_INTERVAL:
+                db.session.commit()
+                last_flush = time.monotonic()
+
+        try:
+            failed_files = build_kbs(json.loads(job.payload), progress_callback=on_progress, cancel_event=event)
+            job.status = 'succeeded'
+            job.stage = 'done'
+            job.failed_files = json.dumps(failed_files, ensure_ascii=False)
+        except KBSBuildCancelled:
+            db.session.rollback()
+            job.status = 'cancelled'
+        except Exception as e:
+            db.session.rollback()
+            logging.error(f"KBS创建失败: {str(e)}", exc_info=True)
+            job.status = 'failed'
+            job.error = str(e)
+        finally:
+            with self._lock:
+                self._cancel_events.pop(job_id, None)
+
+        job.finished_time = datetime.now()
+        db.session.commit()
+
+        if job.status == 'succeeded':
+            # 预热新构建的知识库，首次查询无需等待加载
+            knowledge_warmup.schedule([job.kon_name])
+
+
+# 全局任务管理器
+kbs_job_manager = KBSJobManager()
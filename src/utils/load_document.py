@@ -8,9 +8,18 @@ from langchain_community.document_loaders import (
     CSVLoader
 )
 import pandas as pd
+from langchain.schema import Document
+from openpyxl import load_workbook
+
+# 表格文件每批读取的行数
+TABULAR_CHUNK_ROWS = 10000
 
 
 def load_document(file_path, excel_header_processing=False):
+    """
+    加载文档
+    表格文件开启表头处理时返回惰性生成器，其余类型返回文档列表
+    """
     _, ext = os.path.splitext(file_path)
     ext = ext.lower().strip()  # 去除可能的点号并转小写
 
@@ -44,58 +53,114 @@ def load_document(file_path, excel_header_processing=False):
     return loader.load()
 
 
-def load_excel_with_headers(file_path):
+def _normalize_headers(headers):
+    """
+    规范化表头：空表头使用 "Unnamed: i"，重复表头追加序号
+    """
+    result = []
+    seen = {}
+    for i, header in enumerate(headers):
+        name = f"Unnamed: {i}" if header is None or (isinstance(header, float) and pd.isna(header)) else str(header)
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        result.append(name)
+    return result
+
+
+def _frame_to_documents(df, headers, row_offset, metadata):
+    """
+    将一批表格行转换为 "表头: 值" 文档，按列做向量化拼接
+    Args:
+        df: 当前批次的 DataFrame
+        headers: 表头列表（与列一一对应）
+        row_offset: 当前批次第一行在表格中的序号（从 0 开始，不含表头）
+        metadata: 附加到每个文档的元数据（如工作表名）
+    Yields:
+        Document，metadata 中的 row 为表格中的行号（表头为第 1 行），columns 为表头
+    """
+    if df.empty:
+        return
+    metadata = {**metadata, "columns": ", ".join(headers)}
+
+    content = pd.Series("", index=df.index, dtype=object)
+    for i, header in enumerate(headers):
+        column = df.iloc[:, i]
+        mask = column.notna()
+        if not mask.any():
+            continue
+        part = (f"{header}: " + column.astype(str) + "; ").where(mask, "")
+        content = content + part.astype(object)
+
+    for position, text in enumerate(content.tolist()):
+        if text:  # 只有当有内容时才创建文档
+            yield Document(
+                page_content=text[:-2],
+                metadata={**metadata, "row": row_offset + position + 2}
+            )
+
+
+def load_excel_with_headers(file_path, chunk_rows=TABULAR_CHUNK_ROWS):
     """
     加载Excel文件并将表头拼接到每一行内容中
+    .xlsx 使用 openpyxl 只读模式逐批读取，逐个产出文档，不会一次性载入整张表
     """
     try:
-        # 读取Excel文件
-        excel_file = pd.ExcelFile(file_path)
-        documents = []
-
-        for sheet_name in excel_file.sheet_names:
-            df = pd.read_excel(file_path, sheet_name=sheet_name)
-            headers = df.columns.tolist()
-
-            # 将表头信息添加到每个数据行
-            for _, row in df.iterrows():
-                content_parts = []
-                for i, value in enumerate(row):
-                    if pd.notna(value):  # 只添加非空值
-                        header = headers[i] if i < len(headers) else f"列{i}"
-                        content_parts.append(f"{header}: {value}")
-
-                if content_parts:  # 只有当有内容时才创建文档
-                    content = "; ".join(content_parts)
-                    documents.append(type('Document', (), {'page_content': content, 'metadata': {}})())
-
-        return documents
+        _, ext = os.path.splitext(file_path)
+        if ext.lower() == '.xls':
+            # openpyxl 不支持 .xls，只打开一次文件后按工作表解析
+            excel_file = pd.ExcelFile(file_path)
+            for sheet_name in excel_file.sheet_names:
+                df = excel_file.parse(sheet_name)
+                headers = _normalize_headers(df.columns.tolist())
+                for start in range(0, len(df), chunk_rows):
+                    yield from _frame_to_documents(
+                        df.iloc[start:start + chunk_rows], headers, start, {"sheet": sheet_name}
+                    )
+            return
+
+        workbook = load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            for worksheet in workbook.worksheets:
+                rows = worksheet.iter_rows(values_only=True)
+                header_row = next(rows, None)
+                if header_row is None:
+                    continue
+                headers = _normalize_headers(header_row)
+                width = len(headers)
+
+                batch = []
+                row_offset = 0
+                for row in rows:
+                    batch.append(tuple(row[:width]) + (None,) * (width - len(row)))
+                    if len(batch) >= chunk_rows:
+                        yield from _frame_to_documents(
+                            pd.DataFrame(batch), headers, row_offset, {"sheet": worksheet.title}
+                        )
+                        row_offset += len(batch)
+                        batch = []
+                if batch:
+                    yield from _frame_to_documents(
+                        pd.DataFrame(batch), headers, row_offset, {"sheet": worksheet.title}
+                    )
+        finally:
+            workbook.close()
     except Exception as e:
         raise ValueError(f"处理Excel文件失败: {str(e)}")
 
 
-def load_csv_with_headers(file_path):
+def load_csv_with_headers(file_path, chunk_rows=TABULAR_CHUNK_ROWS):
     """
     加载CSV文件并将表头拼接到每一行内容中
+    使用 read_csv(chunksize=...) 分批读取，逐个产出文档
     """
     try:
-        # 读取CSV文件
-        df = pd.read_csv(file_path, encoding='utf-8')
-        headers = df.columns.tolist()
-        documents = []
-
-        # 将表头信息添加到每个数据行
-        for _, row in df.iterrows():
-            content_parts = []
-            for i, value in enumerate(row):
-                if pd.notna(value):  # 只添加非空值
-                    header = headers[i] if i < len(headers) else f"列{i}"
-                    content_parts.append(f"{header}: {value}")
-
-            if content_parts:  # 只有当有内容时才创建文档
-                content = "; ".join(content_parts)
-                documents.append(type('Document', (), {'page_content': content, 'metadata': {}})())
-
-        return documents
+        row_offset = 0
+        for df in pd.read_csv(file_path, encoding='utf-8', chunksize=chunk_rows):
+            headers = _normalize_headers(df.columns.tolist())
+            yield from _frame_to_documents(df, headers, row_offset, {})
+            row_offset += len(df)
     except Exception as e:
         raise ValueError(f"处理CSV文件失败: {str(e)}")
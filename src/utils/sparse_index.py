@@ -0,0 +1,172 @@
+# src/utils/sparse_index.py
+import json
+import math
+import re
+import zlib
+from collections import Counter
+
+import numpy as np
+
+try:
+    # 可选依赖：安装 jieba 后中文按词切分，否则按字的二元组切分
+    import jieba
+except ImportError:
+    jieba = None
+
+# 稀疏索引编码格式的文件头
+SPARSE_MAGIC = b"KBSBM25\n"
+# BM25 参数
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# 型号、编码、英文单词等整体作为一个词（如 AB-1234.5、iPhone15）
+_CODE_PATTERN = re.compile(r'[A-Za-z0-9]+(?:[._\-/][A-Za-z0-9]+)*')
+_CJK_PATTERN = re.compile(r'[\u4e00-\u9fff]+')
+
+
+def tokenize(text):
+    """
+    中英文混合分词：型号/编码/英文单词整体保留（同时保留按分隔符拆开的部分），
+    中文用 jieba 切词，未安装 jieba 时使用单字 + 二元组
+    """
+    tokens = []
+    for match in _CODE_PATTERN.finditer(text):
+        code = match.group().lower()
+        tokens.append(code)
+        parts = re.split(r'[._\-/]', code)
+        if len(parts) > 1:
+            tokens.extend(p for p in parts if p)
+
+    for match in _CJK_PATTERN.finditer(text):
+        run = match.group()
+        if jieba is not None:
+            tokens.extend(w for w in jieba.lcut_for_search(run) if w.strip())
+        else:
+            tokens.extend(run)
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+class BM25Index:
+    """
+    知识库的 BM25 稀疏倒排索引，文档以 docstore id 标识，与 FAISS 索引一起保存和增量更新
+    """
+
+    def __init__(self, doc_ids=None, doc_lens=None, postings=None):
+        self.doc_ids = list(doc_ids or [])
+        self.doc_lens = np.asarray(doc_lens if doc_lens is not None else [], dtype=np.float32)
+        # term -> (文档位置数组, 词频数组)
+        self.postings = postings or {}
+
+    @classmethod
+    def build(cls, doc_ids, texts):
+        index = cls()
+        index.add(doc_ids, texts)
+        return index
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def add(self, doc_ids, texts):
+        """
+        追加文档
+        """
+        start = len(self.doc_ids)
+        new_terms = {}
+        lens = []
+        for offset, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            lens.append(sum(counts.values()))
+            for term, tf in counts.items():
+                new_terms.setdefault(term, ([], []))
+                new_terms[term][0].append(start + offset)
+                new_terms[term][1].append(tf)
+
+        for term, (positions, tfs) in new_terms.items():
+            positions = np.asarray(positions, dtype=np.int32)
+            tfs = np.asarray(tfs, dtype=np.float32)
+            if term in self.postings:
+                old_positions, old_tfs = self.postings[term]
+                positions = np.concatenate([old_positions, positions])
+                tfs = np.concatenate([old_tfs, tfs])
+            self.postings[term] = (positions, tfs)
+
+        self.doc_ids.extend(doc_ids)
+        self.doc_lens = np.concatenate([self.doc_lens, np.asarray(lens, dtype=np.float32)])
+
+    def remove(self, doc_ids):
+        """
+        删除文档并压缩文档位置
+        """
+        remove = set(doc_ids)
+        keep = np.array([doc_id not in remove for doc_id in self.doc_ids], dtype=bool)
+        if keep.all():
+            return
+        new_position = np.cumsum(keep) - 1
+        postings = {}
+        for term, (positions, tfs) in self.postings.items():
+            mask = keep[positions]
+            if mask.any():
+                postings[term] = (new_position[positions[mask]].astype(np.int32), tfs[mask])
+        self.postings = postings
+        self.doc_ids = [doc_id for doc_id, k in zip(self.doc_ids, keep) if k]
+        self.doc_lens = self.doc_lens[keep]
+
+    def search(self, query, k):
+        """
+        BM25 检索
+        Returns:
+            [(doc_id, score)]，score 为 BM25 分数除以该查询的理论最大分数，范围 [0, 1]
+        """
+        n = len(self.doc_ids)
+        terms = [t for t in dict.fromkeys(tokenize(query)) if t in self.postings]
+        if n == 0 or not terms:
+            return []
+
+        avg_len = float(self.doc_lens.mean()) or 1.0
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lens / avg_len)
+        scores = np.zeros(n, dtype=np.float32)
+        max_score = 0.0
+        for term in terms:
+            positions, tfs = self.postings[term]
+            idf = math.log(1 + (n - len(positions) + 0.5) / (len(positions) + 0.5))
+            scores[positions] += idf * tfs * (BM25_K1 + 1) / (tfs + norm[positions])
+            max_score += idf * (BM25_K1 + 1)
+
+        k = min(k, int(np.count_nonzero(scores)))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.doc_ids[i], float(scores[i]) / max_score) for i in top]
+
+    def serialize(self):
+        payload = {
+            "ids": self.doc_ids,
+            "lens": self.doc_lens.astype(int).tolist(),
+            "postings": {term: [positions.tolist(), tfs.astype(int).tolist()]
+                         for term, (positions, tfs) in self.postings.items()}
+        }
+        raw = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        return SPARSE_MAGIC + zlib.compress(raw)
+
+    @classmethod
+    def deserialize(cls, data):
+        view = memoryview(data)
+        if bytes(view[:len(SPARSE_MAGIC)]) != SPARSE_MAGIC:
+            raise ValueError("不是有效的稀疏索引数据")
+        payload = json.loads(zlib.decompress(view[len(SPARSE_MAGIC):]))
+        postings = {
+            term: (np.asarray(positions, dtype=np.int32), np.asarray(tfs, dtype=np.float32))
+            for term, (positions, tfs) in payload["postings"].items()
+        }
+        return cls(payload["ids"], payload["lens"], postings)
+
+
+def build_sparse_index(vectorstore):
+    """
+    根据向量库的 docstore 构建稀疏索引（用于没有稀疏索引的旧知识库）
+    """
+    docs = vectorstore.docstore._dict
+    doc_ids = [doc_id for _, doc_id in sorted(vectorstore.index_to_docstore_id.items())]
+    return BM25Index.build(doc_ids, [docs[doc_id].page_content for doc_id in doc_ids])
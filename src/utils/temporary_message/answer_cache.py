@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import faiss
+import numpy as np
+
+from src.pojo.KBSconstruction_pojo import KBSconstruction_pojo
+from src.utils.temporary_message.knowledge_index_cache import kbs_version
+
+# 命中缓存所需的最低余弦相似度
+ANSWER_CACHE_THRESHOLD = float(os.environ.get("KBS_ANSWER_CACHE_THRESHOLD", 0.95))
+# 缓存答案的有效期（秒）
+ANSWER_CACHE_TTL = int(os.environ.get("KBS_ANSWER_CACHE_TTL", 3600))
+# 每个智能体最多缓存的答案数，超过后淘汰最早的答案
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get("KBS_ANSWER_CACHE_MAX_ENTRIES", 1000))
+# 向量化问题使用的 Embedding 模型
+ANSWER_CACHE_EMB_MODEL = os.environ.get("KBS_ANSWER_CACHE_EMB_MODEL", "text-embedding-v2")
+
+# 每次查找比较的近邻数
+_LOOKUP_K = 8
+
+
+def knowledge_versions(kb_names):
+    """
+    知识库的当前版本，知识库重建、增量更新或修改配置后版本变化
+    """
+    if not kb_names:
+        return {}
+    rows = KBSconstruction_pojo.query.filter(KBSconstruction_pojo.kon_name.in_(kb_names)).all()
+    versions = {row.kon_name: [str(v) for v in kbs_version(row)] for row in rows}
+    return {name: versions.get(name) for name in kb_names}
+
+
+def answer_fingerprint(agent_config, kb_versions):
+    """
+    智能体配置 + 知识库版本的指纹，任何一项变化后旧答案不再命中
+    """
+    payload = json.dumps({"agent": agent_config, "knowledge": kb_versions}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class _AgentAnswers:
+    """单个智能体的缓存答案和问题向量索引"""
+
+    def __init__(self, dimension):
+        self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(dimension))
+        self.entries = OrderedDict()    # id -> (fingerprint, question, answer, created)
+        self.next_id = 0
+
+    def remove(self, ids):
+        if not ids:
+            return
+        self.index.remove_ids(np.asarray(ids, dtype=np.int64))
+        for entry_id in ids:
+            self.entries.pop(entry_id, None)
+
+
+class AnswerCache:
+    """
+    按智能体划分的语义答案缓存
+    问题向量归一化后存入 FAISS 内积索引，余弦相似度超过阈值且指纹一致、未过期时返回缓存的答案。
+    """
+
+    def __init__(self, threshold=ANSWER_CACHE_THRESHOLD, ttl=ANSWER_CACHE_TTL, max_entries=ANSWER_CACHE_MAX_ENTRIES):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._agents = {}   # agent_id -> _AgentAnswers
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray([vector], dtype=np.float32)
+        faiss.normalize_L2(vector)
+        return vector
+
+    def lookup(self, agent_id, vector, fingerprint):
+        """
+        查找相似问题的缓存答案
+        Returns:
+            (answer, similarity, question)，未命中时 answer 为 None，similarity 为最相似问题的相似度
+        """
+        query = self._normalize(vector)
+        now = time.time()
+        with self._lock:
+            answers = self._agents.get(str(agent_id))
+            best = None
+            if answers is not None and answers.index.ntotal:
+                # 先清理过期的答案
+                answers.remove([i for i, entry in answers.entries.items() if now - entry[3] > self.ttl])
+                if answers.index.ntotal:
+                    scores, ids = answers.index.search(query, min(_LOOKUP_K, answers.index.ntotal))
+                    for score, entry_id in zip(scores[0], ids[0]):
+                        if entry_id == -1:
+                            continue
+                        best = float(score) if best is None else best
+                        if score < self.threshold:
+                            break
+                        fp, question, answer, _ = answers.entries[int(entry_id)]
+                        if fp == fingerprint:
+                            self.hits += 1
+                            return answer, float(score), question
+
+            self.misses += 1
+            return None, best, None
+
+    def store(self, agent_id, vector, fingerprint, question, answer):
+        """
+        缓存答案，超过数量上限时淘汰最早的答案
+        """
+        vector = self._normalize(vector)
+        with self._lock:
+            answers = self._agents.get(str(agent_id))
+            if answers is None or answers.index.d != vector.shape[1]:
+                answers = _AgentAnswers(vector.shape[1])
+                self._agents[str(agent_id)] = answers
+
+            entry_id = answers.next_id
+            answers.next_id += 1
+            answers.index.add_with_ids(vector, np.asarray([entry_id], dtype=np.int64))
+            answers.entries[entry_id] = (fingerprint, question, answer, time.time())
+
+            overflow = len(answers.entries) - self.max_entries
+            if overflow > 0:
+                answers.remove(list(answers.entries)[:overflow])
+                self.evictions += overflow
+
+    def invalidate(self, agent_id=None):
+        """
+        删除智能体的缓存答案，agent_id 为空时清空全部
+        """
+        with self._lock:
+            if agent_id is None:
+                self._agents.clear()
+            else:
+                self._agents.pop(str(agent_id), None)
+
+    def stats(self):
+        """
+        缓存统计
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "agents": len(self._agents),
+                "entries": sum(len(a.entries) for a in self._agents.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "evictions": self.evictions,
+                "threshold": self.threshold,
+                "ttl": self.ttl
+            }
+
+
+answer_cache = AnswerCache()
@@ -0,0 +1,163 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import faiss
+
+# 知识库索引缓存的内存上限（字节），超过后按最近最少使用淘汰
+INDEX_CACHE_MAX_BYTES = int(os.environ.get("KBS_INDEX_CACHE_MAX_BYTES", 4 * 1024 ** 3))
+
+
+def kbs_version(kbs):
+    """
+    知识库索引版本：删除重建会改变 id，重建或增量更新会改变 index_version / update_time
+    """
+    return (kbs.id, kbs.index_version, kbs.update_time)
+
+
+def estimate_vectorstore_bytes(vectorstore):
+    """
+    估算向量库占用的内存：索引编码大小 + 文档文本大小 + 稀疏索引大小
+    """
+    index = faiss.downcast_index(vectorstore.index)
+    code_size = getattr(index, 'code_size', 0) or index.d * 4
+    size = index.ntotal * code_size
+    if isinstance(index, faiss.IndexHNSW):
+        # HNSW 图的邻居表
+        size += index.hnsw.neighbors.size() * 4
+    for doc in vectorstore.docstore._dict.values():
+        size += len(doc.page_content.encode('utf-8'))
+    sparse_index = getattr(vectorstore, 'sparse_index', None)
+    if sparse_index is not None:
+        # 稀疏索引的倒排表
+        size += sum(positions.nbytes + tfs.nbytes for positions, tfs in sparse_index.postings.values())
+    return size
+
+
+class _Loading:
+    """正在加载的知识库，同一版本的并发请求等待同一次加载"""
+
+    def __init__(self, version):
+        self.version = version
+        self.event = threading.Event()
+        self.error = None
+
+
+class KnowledgeIndexCache:
+    """
+    按字节预算的知识库索引 LRU 缓存
+    条目按版本校验，版本变化后重新加载；冷启动时同一知识库只反序列化一次。
+    """
+
+    def __init__(self, max_bytes=INDEX_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()   # kon_name -> (version, vectorstore, size)
+        self._loading = {}              # kon_name -> _Loading
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, name, version, loader):
+        """
+        获取知识库向量库
+        Args:
+            name: 知识库名称
+            version: 当前版本，与缓存中的版本不同时重新加载
+            loader: 无参函数，返回向量库
+        Returns:
+            向量库
+        """
+        while True:
+            with self._lock:
+                entry = self._entries.get(name)
+                if entry is not None and entry[0] == version:
+                    self._entries.move_to_end(name)
+                    self.hits += 1
+                    return entry[1]
+
+                loading = self._loading.get(name)
+                if loading is None or loading.version != version:
+                    loading = _Loading(version)
+                    self._loading[name] = loading
+                    self.misses += 1
+                    break
+
+            # 其他线程正在加载同一版本，等待完成后重新查找
+            loading.event.wait()
+            if loading.error is not None:
+                raise loading.error
+
+        try:
+            started = time.perf_counter()
+            vectorstore = loader()
+            size = estimate_vectorstore_bytes(vectorstore)
+            print(f"知识库 {name} 加载完成，约 {size / 1024 ** 2:.1f}MB，耗时 {time.perf_counter() - started:.2f}s")
+        except Exception as e:
+            loading.error = e
+            with self._lock:
+                if self._loading.get(name) is loading:
+                    del self._loading[name]
+            loading.event.set()
+            raise
+
+        with self._lock:
+            if self._loading.get(name) is loading:
+                del self._loading[name]
+                self._remove(name)
+                self._entries[name] = (version, vectorstore, size)
+                self._total_bytes += size
+                self._evict(keep=name)
+        loading.event.set()
+        return vectorstore
+
+    def _remove(self, name):
+        entry = self._entries.pop(name, None)
+        if entry is not None:
+            self._total_bytes -= entry[2]
+
+    def _evict(self, keep):
+        while self._total_bytes > self.max_bytes:
+            name = next((n for n in self._entries if n != keep), None)
+            if name is None:
+                break
+            self._remove(name)
+            self.evictions += 1
+            logging.info(f"知识库索引缓存淘汰 {name}，当前大小 {self._total_bytes} 字节")
+
+    def invalidate(self, name):
+        """
+        删除缓存中的知识库（删除、重建或更新后调用）
+        """
+        with self._lock:
+            self._remove(name)
+            # 正在加载的旧版本不再写入缓存
+            self._loading.pop(name, None)
+
+    def contains(self, name, version=None):
+        with self._lock:
+            entry = self._entries.get(name)
+            return entry is not None and (version is None or entry[0] == version)
+
+    def stats(self):
+        """
+        缓存统计
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "evictions": self.evictions,
+                "knowledge_bases": list(self._entries)
+            }
+
+
+knowledge_index_cache = KnowledgeIndexCache()
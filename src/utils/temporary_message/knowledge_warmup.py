@@ -0,0 +1,155 @@
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from database.database import db
+from src.pojo.agent_pojo import AgentPojo
+from src.pojo.conversation_history_pojo import ConversationHistory
+from src.pojo.KBSconstruction_pojo import KBSconstruction_pojo
+from src.utils.temporary_message.knowledge_index_cache import knowledge_index_cache
+from src.utils.temporary_message.search_multiple_kbs import load_knowledge
+
+# 是否在启动时预热知识库索引
+WARMUP_ENABLED = os.environ.get("KBS_WARMUP", "y") == "y"
+# 启动时预热的知识库（逗号分隔），为空时按使用情况排序选择
+WARMUP_KBS = os.environ.get("KBS_WARMUP_KBS", "")
+# 按使用情况选择时预热的知识库数量
+WARMUP_TOP_N = int(os.environ.get("KBS_WARMUP_TOP_N", 10))
+
+
+def rank_knowledge_bases(limit=WARMUP_TOP_N):
+    """
+    按使用情况排序知识库：引用该知识库的智能体数量 + 这些智能体的对话次数
+    """
+    conversations = dict(
+        db.session.query(ConversationHistory.agent_id, db.func.count(ConversationHistory.id))
+        .group_by(ConversationHistory.agent_id)
+        .all()
+    )
+    existing = {name for (name,) in db.session.query(KBSconstruction_pojo.kon_name)}
+
+    scores = Counter()
+    for agent_id, llm_knowledge in db.session.query(AgentPojo.agent_id, AgentPojo.llm_knowledge):
+        if not llm_knowledge:
+            continue
+        for name in (n.strip() for n in llm_knowledge.split(",")):
+            if name in existing:
+                scores[name] += 1 + conversations.get(str(agent_id), 0)
+    return [name for name, _ in scores.most_common(limit)]
+
+
+class KnowledgeWarmup:
+    """
+    在后台线程中把知识库索引预先加载到索引缓存
+    启动时预热配置的或最常用的知识库，知识库构建/更新完成后预热对应知识库。
+    """
+
+    def __init__(self):
+        self.app = None
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._startup_done = threading.Event()
+        self._progress = {
+            "status": "idle",       # idle/running/done
+            "total": 0,
+            "loaded": 0,
+            "failed": [],
+            "current": None,
+            "started_time": None,
+            "finished_time": None
+        }
+
+    def init_app(self, app):
+        """
+        绑定 Flask 应用并启动预热线程
+        """
+        if multiprocessing.current_process().name != "MainProcess":
+            # spawn 启动的解析子进程会重新导入主模块，子进程中不启动预热线程
+            return
+        with self._lock:
+            if self.app is not None:
+                return
+            self.app = app
+
+        threading.Thread(target=self._worker, name="kbs-warmup", daemon=True).start()
+        if WARMUP_ENABLED:
+            self._queue.put(None)   # None 表示启动预热
+        else:
+            self._startup_done.set()
+
+    def schedule(self, names):
+        """
+        预热指定知识库（构建或更新完成后调用）
+        """
+        if self.app is None:
+            return
+        names = [n for n in names if n]
+        if names:
+            self._queue.put(names)
+
+    def _worker(self):
+        while True:
+            names = self._queue.get()
+            try:
+                with self.app.app_context():
+                    if names is None:
+                        names = [n.strip() for n in WARMUP_KBS.split(",") if n.strip()] or rank_knowledge_bases()
+                    self._warm(names)
+            except Exception as e:
+                logging.error(f"知识库预热失败: {str(e)}", exc_info=True)
+            finally:
+                self._startup_done.set()
+                self._queue.task_done()
+
+    def _warm(self, names):
+        started = time.perf_counter()
+        with self._lock:
+            self._progress.update(status="running", total=len(names), loaded=0, failed=[], current=None,
+                                  started_time=datetime.now().strftime('%Y-%m-%d %H:%M:%S'), finished_time=None)
+        print(f"开始预热知识库: {names}")
+
+        for name in names:
+            with self._lock:
+                self._progress["current"] = name
+            stats = knowledge_index_cache.stats()
+            if stats["bytes"] >= stats["max_bytes"]:
+                # 缓存已满，继续加载只会淘汰刚预热的知识库
+                logging.warning(f"知识库索引缓存已满，停止预热，剩余: {names[names.index(name):]}")
+                break
+
+            entry = KBSconstruction_pojo.query.filter_by(kon_name=name).first()
+            try:
+                if entry is None:
+                    raise ValueError("知识库不存在")
+                load_knowledge(entry)
+                with self._lock:
+                    self._progress["loaded"] += 1
+            except Exception as e:
+                logging.warning(f"预热知识库 {name} 失败: {str(e)}")
+                with self._lock:
+                    self._progress["failed"].append({"kon_name": name, "error": str(e)})
+
+        with self._lock:
+            self._progress.update(status="done", current=None,
+                                  finished_time=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        print(f"知识库预热完成，耗时 {time.perf_counter() - started:.2f}s")
+
+    def is_ready(self):
+        """
+        启动预热是否已完成
+        """
+        return self._startup_done.is_set()
+
+    def progress(self):
+        with self._lock:
+            progress = dict(self._progress, failed=list(self._progress["failed"]))
+        progress["ready"] = self.is_ready()
+        return progress
+
+
+knowledge_warmup = KnowledgeWarmup()
@@ -1,26 +1,122 @@
 # src/utils/model_loader.py
+import hashlib
+import threading
+
 from langchain_community.chat_models import ChatOpenAI
 from langchain_community.chat_models import ChatTongyi
+from sqlalchemy import event, inspect
 
-def load_model(model_name: str, api_key: str, temperature: float = 0.8, max_tokens: int = 2048):
-    # 判断模型类型
+from src.pojo.model_pojo import ModelPojo
+
+
+def model_provider(model_name: str):
+    """
+    根据模型名称判断模型服务商
+    """
     if model_name.startswith("qwen"):
+        return "dashscope"
+    elif model_name.startswith("deepseek"):
+        return "deepseek"
+    else:
+        raise ValueError(f"不支持的模型: {model_name}")
+
+
+def _create_client(provider: str, model_name: str, api_key: str):
+    if provider == "dashscope":
         # 阿里云 Qwen
         return ChatTongyi(
             model=model_name,
             api_key=api_key,
-            base_url="https://dashscope.aliyuncs.com/api/v1",
-            temperature=temperature,
-            max_tokens=max_tokens
-        )
-    elif model_name.startswith("deepseek"):
-        # Deepseek
-        return ChatOpenAI(
-            model_name=model_name,
-            openai_api_key=api_key,
-            base_url="https://api.deepseek.com/v1",
-            temperature=temperature,
-            max_tokens=max_tokens
+            base_url="https://dashscope.aliyuncs.com/api/v1"
         )
-    else:
-        raise ValueError(f"不支持的模型: {model_name}")
+    # Deepseek
+    return ChatOpenAI(
+        model_name=model_name,
+        openai_api_key=api_key,
+        base_url="https://api.deepseek.com/v1"
+    )
+
+
+class LLMClientRegistry:
+    """
+    进程内共享的模型客户端，按 服务商/模型/密钥 缓存，避免每次请求重新创建客户端
+    Deepseek（ChatOpenAI）复用客户端即复用其 HTTP 连接池；Qwen（ChatTongyi）通过 dashscope SDK 请求，不持有连接池。
+    temperature、max_tokens 等生成参数在每次调用时传入，不影响缓存；模型记录变化时淘汰对应客户端。
+    """
+
+    def __init__(self):
+        self._clients = {}  # (provider, model_name, key_hash) -> client
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _key(model_name, api_key):
+        # 不在缓存键中保存明文密钥
+        key_hash = hashlib.sha256((api_key or "").encode('utf-8')).hexdigest()[:16]
+        return model_provider(model_name), model_name, key_hash
+
+    def get(self, model_name: str, api_key: str):
+        """
+        获取模型客户端，不存在时创建
+        """
+        key = self._key(model_name, api_key)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is not None:
+                self.hits += 1
+                return client
+            self.misses += 1
+            client = _create_client(key[0], model_name, api_key)
+            self._clients[key] = client
+            return client
+
+    def evict(self, model_name: str = None):
+        """
+        淘汰模型的客户端，model_name 为空时全部淘汰
+        """
+        with self._lock:
+            keys = [key for key in self._clients if model_name is None or key[1] == model_name]
+            for key in keys:
+                del self._clients[key]
+            self.evictions += len(keys)
+        if keys:
+            print(f"淘汰模型客户端: {model_name or '全部'}，共 {len(keys)} 个")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "clients": len(self._clients),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+
+llm_registry = LLMClientRegistry()
+
+
+@event.listens_for(ModelPojo.model_name, 'set', active_history=True)
+def _load_old_model_name(target, value, oldvalue, initiator):
+    # 修改模型名称时先加载旧值（提交后属性已过期），after_update 才能从属性历史取得旧名称
+    pass
+
+
+@event.listens_for(ModelPojo, 'after_insert')
+@event.listens_for(ModelPojo, 'after_update')
+@event.listens_for(ModelPojo, 'after_delete')
+def _evict_changed_model(mapper, connection, target):
+    # 模型记录（如密钥）变化后，旧客户端不再使用；修改了模型名称时同时淘汰旧名称的客户端
+    names = {target.model_name}
+    names.update(inspect(target).attrs.model_name.history.deleted or ())
+    for name in names:
+        llm_registry.evict(name)
+
+
+def load_model(model_name: str, api_key: str, temperature: float = 0.8, max_tokens: int = 2048):
+    """
+    获取共享的模型客户端，并绑定本次调用的生成参数
+    :return: 可直接 invoke / stream，或传给 LLMChain 的 Runnable
+    """
+    return llm_registry.get(model_name, api_key).bind(temperature=temperature, max_tokens=max_tokens)
@@ -0,0 +1,251 @@
+import json
+import logging
+import os
+import threading
+
+import faiss
+import numpy as np
+
+try:
+    # 可选依赖：安装 sentence-transformers 后支持本地 cross-encoder 重排序
+    from sentence_transformers import CrossEncoder
+except ImportError:
+    CrossEncoder = None
+
+# MROD 为 "MMR" 时使用的默认 lambda（越大越偏向相关性，越小越偏向多样性）
+MMR_LAMBDA = float(os.environ.get("KBS_MMR_LAMBDA", 0.5))
+# 启用 MMR 或重排序时，每个知识库召回的候选数倍数
+CANDIDATE_FACTOR = int(os.environ.get("KBS_RERANK_CANDIDATE_FACTOR", 4))
+# sorting_config 只写 "rerank" 时使用的 cross-encoder 模型
+RERANK_MODEL = os.environ.get("KBS_RERANK_MODEL", "BAAI/bge-reranker-base")
+# 自适应 top-k：相邻结果的分数差超过该值时截断后面的结果，<=0 表示不截断
+ADAPTIVE_SCORE_GAP = float(os.environ.get("KBS_ADAPTIVE_SCORE_GAP", 0.15))
+
+_rerankers = {}
+_reranker_lock = threading.Lock()
+_positions_lock = threading.Lock()
+
+
+def parse_mrod(mrod):
+    """
+    解析知识库的 MROD 配置
+    - "MMR": 使用默认 lambda 做 MMR 多样化
+    - "0.7": 使用指定 lambda（0~1）做 MMR 多样化
+    - 其他: 不做多样化，按相关性排序
+    Returns:
+        MMR 的 lambda，None 表示不启用
+    """
+    value = str(mrod or "").strip()
+    if value.lower() == "mmr":
+        return MMR_LAMBDA
+    try:
+        lambda_mult = float(value)
+    except ValueError:
+        return None
+    return lambda_mult if 0 <= lambda_mult <= 1 else None
+
+
+def parse_sorting_config(sorting_config):
+    """
+    解析知识库的 sorting_config 配置
+    - JSON 对象: {"score_threshold": 0.5, "reranker": "BAAI/bge-reranker-base"}，reranker 为 true 时使用默认模型
+    - "rerank" / "rerank:<模型>": 使用 cross-encoder 重排序
+    - 其他（如 "relevance"）: 按检索分数排序
+    Returns:
+        {"score_threshold": float 或 None, "reranker": 模型名称或 None}
+    """
+    config = {"score_threshold": None, "reranker": None}
+    value = str(sorting_config or "").strip()
+    if value.startswith("{"):
+        try:
+            data = json.loads(value)
+        except ValueError:
+            logging.warning(f"sorting_config 不是有效的 JSON: {value}")
+            return config
+        if data.get("score_threshold") is not None:
+            config["score_threshold"] = float(data["score_threshold"])
+        reranker = data.get("reranker")
+        if reranker:
+            config["reranker"] = RERANK_MODEL if reranker is True else str(reranker)
+        return config
+
+    mode, _, model = value.partition(":")
+    if mode.strip().lower() == "rerank":
+        config["reranker"] = model.strip() or RERANK_MODEL
+    return config
+
+
+def get_reranker(model_name):
+    """
+    获取 cross-encoder 模型（按模型名称共享），未安装 sentence-transformers 时返回 None
+    """
+    if CrossEncoder is None:
+        return None
+    with _reranker_lock:
+        if model_name not in _rerankers:
+            print(f"加载重排序模型: {model_name}")
+            _rerankers[model_name] = CrossEncoder(model_name)
+        return _rerankers[model_name]
+
+
+def rerank(query, texts, model_name):
+    """
+    使用 cross-encoder 计算查询与文档的相关性分数
+    Returns:
+        np.ndarray，范围 [0, 1]；模型不可用时返回 None
+    """
+    model = get_reranker(model_name)
+    if model is None:
+        logging.warning("未安装 sentence-transformers，跳过重排序")
+        return None
+    scores = np.asarray(model.predict([(query, text) for text in texts]), dtype=np.float32).reshape(-1)
+    if scores.size and (scores.min() < 0 or scores.max() > 1):
+        # 模型输出的是 logits，转换为概率
+        scores = 1.0 / (1.0 + np.exp(-scores))
+    return scores
+
+
+def mmr_select(scores, vectors, k, lambda_mult):
+    """
+    向量化的 MMR：每一步选择 lambda * 相关性 - (1 - lambda) * 与已选文档的最大相似度 最大的文档
+    Args:
+        scores: 候选文档的相关性分数
+        vectors: 候选文档的向量
+        k: 选择的数量
+        lambda_mult: 相关性权重
+    Returns:
+        选中的候选位置列表（按选择顺序）
+    """
+    scores = np.asarray(scores, dtype=np.float32)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    similarity = vectors @ vectors.T
+
+    k = min(k, len(scores))
+    selected = []
+    max_similarity = np.zeros(len(scores), dtype=np.float32)
+    available = np.ones(len(scores), dtype=bool)
+    for _ in range(k):
+        mmr = lambda_mult * scores - (1 - lambda_mult) * max_similarity
+        mmr[~available] = -np.inf
+        best = int(np.argmax(mmr))
+        selected.append(best)
+        available[best] = False
+        max_similarity = np.maximum(max_similarity, similarity[best])
+    return selected
+
+
+def _docstore_positions(vs):
+    """
+    docstore id -> 索引位置（缓存在向量库上，缓存中的向量库不会被修改）
+    """
+    positions = getattr(vs, 'docstore_positions', None)
+    if positions is None:
+        with _positions_lock:
+            positions = getattr(vs, 'docstore_positions', None)
+            if positions is None:
+                positions = {doc_id: i for i, doc_id in vs.index_to_docstore_id.items()}
+                vs.docstore_positions = positions
+    return positions
+
+
+def prepare_index(vs):
+    """
+    发布到缓存前的一次性准备：建立 docstore id 到索引位置的映射，IVF 索引建立 id 到倒排表位置的映射
+    缓存中的索引会被多个线程同时检索，之后不再修改
+    """
+    _docstore_positions(vs)
+    ivf = faiss.try_extract_index_ivf(vs.index)
+    if ivf is not None and ivf.direct_map.type == faiss.DirectMap.NoMap:
+        try:
+            ivf.make_direct_map()
+        except RuntimeError as e:
+            logging.warning(f"索引无法建立 direct map，MMR 将不可用: {str(e)}")
+    return vs
+
+
+def reconstruct_vectors(vs, doc_ids):
+    """
+    从 FAISS 索引取回文档向量（PQ 索引为近似向量），不支持时返回 None
+    IVF 索引需要先经 prepare_index 建立 direct map
+    """
+    positions = _docstore_positions(vs)
+    index = vs.index
+    try:
+        return np.stack([index.reconstruct(positions[doc_id]) for doc_id in doc_ids])
+    except RuntimeError as e:
+        logging.warning(f"索引不支持取回向量，跳过 MMR: {str(e)}")
+        return None
+
+
+def candidate_count(k, lambda_mult, config):
+    """
+    启用 MMR 或重排序时多召回候选
+    """
+    if lambda_mult is not None or config["reranker"]:
+        return k * CANDIDATE_FACTOR
+    return k
+
+
+def post_process(vs, query, ranked, k, lambda_mult=None, config=None):
+    """
+    检索后处理：cross-encoder 重排序 -> 分数阈值截断 -> MMR 多样化 -> 取前 k 个
+    Args:
+        vs: 向量库
+        query: 查询文本
+        ranked: 检索结果 [(doc_id, score)]，按分数降序
+        k: 返回数量
+        lambda_mult: MMR 的 lambda，None 表示不启用
+        config: parse_sorting_config 的结果
+    Returns:
+        [(doc_id, score)]，按分数降序
+    """
+    config = config or {"score_threshold": None, "reranker": None}
+    if not ranked:
+        return ranked
+
+    if config["reranker"]:
+        texts = [vs.docstore.search(doc_id).page_content for doc_id, _ in ranked]
+        scores = rerank(query, texts, config["reranker"])
+        if scores is not None:
+            ranked = sorted(zip((doc_id for doc_id, _ in ranked), scores.tolist()),
+                            key=lambda item: item[1], reverse=True)
+
+    if config["score_threshold"] is not None:
+        ranked = [(doc_id, score) for doc_id, score in ranked if score >= config["score_threshold"]]
+
+    if lambda_mult is not None and len(ranked) > 1:
+        vectors = reconstruct_vectors(vs, [doc_id for doc_id, _ in ranked])
+        if vectors is not None:
+            selected = mmr_select([score for _, score in ranked], vectors, k, lambda_mult)
+            # 选中的文档仍按分数降序返回，便于与其他知识库的结果合并
+            return sorted((ranked[i] for i in selected), key=lambda item: item[1], reverse=True)
+    return ranked[:k]
+
+
+def apply_relevance_threshold(ranked, threshold):
+    """
+    去掉分数低于知识库相关性阈值的结果
+    只用于向量检索的余弦相似度，在融合和重排序之前调用；cross-encoder 的分数另由 sorting_config 的 score_threshold 过滤
+    Returns:
+        (保留的结果, 去掉的数量)
+    """
+    if threshold is None:
+        return ranked, 0
+    kept = [item for item in ranked if item[-1] >= threshold]
+    return kept, len(ranked) - len(kept)
+
+
+def adaptive_cut(scores, gap=ADAPTIVE_SCORE_GAP):
+    """
+    自适应 top-k：在按分数降序的结果中，找到第一个与前一个结果分数差超过 gap 的位置
+    只用于单个知识库的向量相似度，融合分数中只被一路检索命中的结果天然偏低，不能按断层截断
+    Returns:
+        保留的数量
+    """
+    if gap <= 0:
+        return len(scores)
+    for i in range(1, len(scores)):
+        if scores[i - 1] - scores[i] > gap:
+            return i
+    return len(scores)
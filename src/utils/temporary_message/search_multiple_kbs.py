@@ -1,60 +1,364 @@
-from typing import List
+import heapq
+import os
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
 import faiss
 import numpy as np
 from langchain.schema import Document
 from src.pojo.KBSconstruction_pojo import KBSconstruction_pojo
 from langchain_community.vectorstores import FAISS
-from langchain_community.embeddings import DashScopeEmbeddings
+from src.utils.index_store import has_index, load_index
+from src.utils.sparse_index import build_sparse_index
+from src.utils.embedding_executor import EmbeddingExecutor
+from src.utils.vectorize_documents import get_embeddings, resolve_model_name
+from src.utils.temporary_message.knowledge_index_cache import knowledge_index_cache, kbs_version
+from src.utils.temporary_message.post_retrieval import (parse_mrod, parse_sorting_config, candidate_count, post_process,
+                                                        apply_relevance_threshold, adaptive_cut, prepare_index,
+                                                        ADAPTIVE_SCORE_GAP)
 import traceback
 
-embeddings = DashScopeEmbeddings(
-    model="text-embedding-v2",
-    dashscope_api_key="your-key"
-)
+# 并行检索多个知识库的线程数（FAISS 检索时会释放 GIL）
+SEARCH_WORKERS = int(os.environ.get("KBS_SEARCH_WORKERS", 8))
 
-knowledge_cache = {}
+# 检索模式（由知识库的 similarity 配置决定）
+RETRIEVAL_VECTOR = "vector"
+RETRIEVAL_KEYWORD = "keyword"
+RETRIEVAL_HYBRID = "hybrid"
+# RRF 融合常数
+RRF_K = 60
+# 混合检索时每路召回的候选数倍数
+HYBRID_CANDIDATE_FACTOR = 3
 
-def search_multiple_kbs(kon_names: List[str], query: str, top_k: int = 5) -> List[Document]:
-    all_docs = []
-    for name in kon_names:
-        # 检查缓存
-        if name in knowledge_cache:
-            vs = knowledge_cache[name]
-        else:
-            entry = KBSconstruction_pojo.query.filter_by(kon_name=name).first()
-            if not entry or not entry.pkl_index_data or not entry.faiss_index_data:
-                continue
+_search_pool = ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix="kbs-search")
+_embeddings_cache = {}
+_embeddings_lock = threading.Lock()
+_sparse_lock = threading.Lock()
+
+
+def get_model_embeddings(emb_model):
+    """
+    获取知识库构建时使用的 Embedding 模型（按实际模型名称共享同一个对象）
+    """
+    model_name = resolve_model_name(emb_model)
+    with _embeddings_lock:
+        if model_name not in _embeddings_cache:
+            _embeddings_cache[model_name] = get_embeddings(emb_model)
+        return _embeddings_cache[model_name]
+
+
+def load_knowledge(entry):
+    """
+    从索引缓存获取知识库向量库，版本变化时重新加载
+    """
+    def loader():
+        if not has_index(entry):
+            raise ValueError("知识库没有索引数据")
+        return prepare_index(load_index(entry, get_model_embeddings(entry.emb_moddle)))
+
+    return knowledge_index_cache.get(entry.kon_name, kbs_version(entry), loader)
+
+
+def normalize_score(score, metric_type):
+    """
+    把 FAISS 返回的分数统一为余弦相似度（越大越相关），便于合并不同度量/模型的知识库结果
+    DashScope 返回的向量已归一化，L2 距离平方 d 与余弦相似度满足 cos = 1 - d / 2
+    """
+    if metric_type == faiss.METRIC_INNER_PRODUCT:
+        return float(score)
+    return 1.0 - float(score) / 2.0
+
+
+def parse_similarity(similarity):
+    """
+    解析知识库的 similarity 配置
+    - "keyword" / "bm25" / "关键词": 仅关键词检索（不需要向量化查询）
+    - "hybrid" / "混合": 向量 + 关键词，RRF 融合
+    - "hybrid:0.7": 向量 + 关键词，按权重融合（0.7 为向量分数的权重）
+    - 其他（如 "0.8"、"vector"）: 仅向量检索
+    Returns:
+        (mode, weight)，weight 为 None 表示使用 RRF
+    """
+    mode, _, weight = str(similarity or "").strip().lower().partition(":")
+    mode = mode.strip()
+    if mode in ("keyword", "bm25", "关键词"):
+        return RETRIEVAL_KEYWORD, None
+    if mode in ("hybrid", "混合"):
+        try:
+            weight = float(weight) if weight.strip() else None
+        except ValueError:
+            weight = None
+        if weight is not None and not 0 <= weight <= 1:
+            weight = None
+        return RETRIEVAL_HYBRID, weight
+    return RETRIEVAL_VECTOR, None
+
+
+def get_sparse_index(vs):
+    """
+    获取向量库的稀疏索引，旧知识库没有保存稀疏索引时根据 docstore 构建一次
+    """
+    sparse_index = getattr(vs, 'sparse_index', None)
+    if sparse_index is None:
+        with _sparse_lock:
+            sparse_index = getattr(vs, 'sparse_index', None)
+            if sparse_index is None:
+                sparse_index = build_sparse_index(vs)
+                vs.sparse_index = sparse_index
+    return sparse_index
+
+
+def _dense_search(vs, query_vectors, k):
+    """
+    向量检索，一次 index.search 检索所有查询
+    Args:
+        query_vectors: 查询向量矩阵 (查询数, 维度)
+    Returns:
+        每个查询按归一化分数降序排列的 [(doc_id, score)]
+    """
+    scores, indices = vs.index.search(np.asarray(query_vectors, dtype=np.float32), k)
+    metric_type = vs.index.metric_type
+    results = []
+    for row_scores, row_indices in zip(scores, indices):
+        ranked = [(vs.index_to_docstore_id[i], normalize_score(score, metric_type))
+                  for score, i in zip(row_scores, row_indices) if i != -1]
+        results.append(sorted(ranked, key=lambda item: item[1], reverse=True))
+    return results
+
+
+def _fuse(dense, sparse, k, weight=None):
+    """
+    融合向量与关键词检索结果
+    weight 为 None 时使用 RRF（按 2/(RRF_K+1) 归一化到 [0, 1]），否则按 weight * 向量分数 + (1 - weight) * 关键词分数
+    """
+    fused = Counter()
+    if weight is None:
+        for ranked in (dense, sparse):
+            for rank, (doc_id, _) in enumerate(ranked, start=1):
+                fused[doc_id] += 1.0 / (RRF_K + rank)
+        scale = (RRF_K + 1) / 2.0
+        return [(doc_id, score * scale) for doc_id, score in fused.most_common(k)]
+
+    for doc_id, score in dense:
+        fused[doc_id] += weight * max(score, 0.0)
+    for doc_id, score in sparse:
+        fused[doc_id] += (1 - weight) * score
+    return fused.most_common(k)
+
+
+def _filter_dense(dense, threshold, score_gap=ADAPTIVE_SCORE_GAP):
+    """
+    向量检索结果（归一化的余弦相似度）的相关性阈值和自适应截断
+    只作用于向量分数：融合分数和 BM25 分数基于排名或词频，不能与同一阈值比较
+    Returns:
+        (保留的结果, 低于阈值去掉的数量, 分数断层去掉的数量)
+    """
+    dense, below_threshold = apply_relevance_threshold(dense, threshold)
+    kept = adaptive_cut([score for _, score in dense], score_gap)
+    return dense[:kept], below_threshold, len(dense) - kept
 
-            # 反序列化并缓存
-            try:
-                pkl_data = entry.pkl_index_data
-                if isinstance(pkl_data, str):
-                    pkl_data = pkl_data.encode('latin1')
 
-                faiss_data = entry.faiss_index_data
-                if isinstance(faiss_data, str):
-                    faiss_data = faiss_data.encode('latin1')
+def _search_kb(vs, queries, query_vectors, k, entry, score_gap=ADAPTIVE_SCORE_GAP):
+    """
+    检索单个知识库：向量结果先按相关性阈值和分数断层过滤，再与关键词结果融合，最后做检索后处理（重排序 / 阈值 / MMR）
+    Args:
+        queries: 查询文本列表
+        query_vectors: 查询向量矩阵，仅关键词检索时为 None
+        score_gap: 自适应截断的分数差，<=0 表示不截断
+    Returns:
+        (每个查询按分数降序排列的 [(score, doc)], 统计)
+    """
+    mode, weight = parse_similarity(entry.similarity)
+    lambda_mult = parse_mrod(entry.MROD)
+    config = parse_sorting_config(entry.sorting_config)
+    fetch_k = candidate_count(k, lambda_mult, config)
+    candidates = fetch_k * HYBRID_CANDIDATE_FACTOR if mode == RETRIEVAL_HYBRID else fetch_k
 
-                index = faiss.deserialize_index(np.frombuffer(faiss_data, dtype=np.uint8))
-                vs = FAISS.deserialize_from_bytes(pkl_data, embeddings, allow_dangerous_deserialization=True)
-                vs.index = index
+    if mode == RETRIEVAL_KEYWORD:
+        dense_lists = [None] * len(queries)
+    else:
+        dense_lists = _dense_search(vs, query_vectors, candidates)
+    sparse_index = get_sparse_index(vs) if mode != RETRIEVAL_VECTOR else None
 
-                # 存入缓存
-                knowledge_cache[name] = vs
+    results = []
+    stats = {"retrieved": 0, "below_threshold": 0, "score_gap": 0}
+    for query, dense in zip(queries, dense_lists):
+        dropped = 0
+        if dense is not None:
+            dense, below_threshold, below_gap = _filter_dense(dense, entry.relevance_threshold, score_gap)
+            stats["below_threshold"] += below_threshold
+            stats["score_gap"] += below_gap
+            dropped = below_threshold + below_gap
 
-            except Exception as e:
-                print(f"🔥 加载知识库 {name} 出错: {str(e)}")
-                continue
+        if mode == RETRIEVAL_KEYWORD:
+            ranked = sparse_index.search(query, fetch_k)
+        elif mode == RETRIEVAL_HYBRID:
+            ranked = _fuse(dense, sparse_index.search(query, candidates), fetch_k, weight)
+        else:
+            ranked = dense
+        ranked = post_process(vs, query, ranked, k, lambda_mult, config)
+        stats["retrieved"] += len(ranked) + dropped
+        results.append([(score, vs.docstore.search(doc_id)) for doc_id, score in ranked])
+    return results, stats
+
+
+def _load_stores(kon_names):
+    """
+    一次查询所有知识库的元数据（索引数据延迟加载，仅在缓存未命中时读取），从索引缓存获取向量库
+    Returns:
+        [(entry, vectorstore)]
+    """
+    entries = {e.kon_name: e for e in KBSconstruction_pojo.query.filter(KBSconstruction_pojo.kon_name.in_(kon_names))}
+    stores = []
+    for name in kon_names:
+        entry = entries.get(name)
+        if not entry:
+            continue
+
+        try:
+            stores.append((entry, load_knowledge(entry)))
+        except Exception as e:
+            print(f"🔥 加载知识库 {name} 出错: {str(e)}")
+            continue
+    return stores
 
-        # 搜索
-        docs = vs.similarity_search(query, k=top_k)
-        all_docs.extend(docs)
 
-    # 去重逻辑
+def _merge(ranked_lists, top_k, per_kb_quota=None):
+    """
+    各知识库结果已按分数降序，堆合并后去重并应用单库配额
+    Returns:
+        [(doc, score, kon_name)]
+    """
+    results = []
     seen = set()
-    unique = []
-    for d in all_docs:
-        if d.page_content not in seen:
-            seen.add(d.page_content)
-            unique.append(d)
-    return unique[:top_k]
+    taken = Counter()
+    for score, name, doc in heapq.merge(*ranked_lists, key=lambda item: -item[0]):
+        if doc.page_content in seen or (per_kb_quota and taken[name] >= per_kb_quota):
+            continue
+        seen.add(doc.page_content)
+        taken[name] += 1
+        results.append((doc, score, name))
+        if len(results) >= top_k:
+            break
+    return results
+
+
+def search_multiple_kbs_with_scores(kon_names: List[str], query: str, top_k: int = 5,
+                                    per_kb_quota: int = None, metrics: dict = None) -> List[Tuple[Document, float, str]]:
+    """
+    联合检索多个知识库：按各知识库的 similarity 配置进行向量/关键词/混合检索，按 MROD / sorting_config 做检索后处理，
+    收集每个知识库的 (分数, 文档)，按分数用堆合并为全局 top_k
+    Args:
+        kon_names: 知识库名称列表
+        query: 查询文本
+        top_k: 返回的文档数
+        per_kb_quota: 单个知识库最多贡献的文档数，同时作为每个知识库的候选数，默认不限制（候选数为 top_k）
+        metrics: 传入字典时写入本次检索的统计（检索数量、各阶段去掉的数量、没有结果的知识库）
+    Returns:
+        [(doc, score, kon_name)]，按分数（归一化的相似度，由距离换算）降序；
+        向量相似度低于知识库 relevance_threshold 的结果会在融合和重排序前去掉，
+        向量相似度出现明显断层时只保留该知识库断层之前的向量结果（关键词结果不受影响）
+    """
+    stores = _load_stores(kon_names)
+
+    # 每个 Embedding 模型只向量化一次查询，仅关键词检索的知识库不需要向量化
+    query_vectors = {}
+    for entry, _ in stores:
+        model_name = resolve_model_name(entry.emb_moddle)
+        if parse_similarity(entry.similarity)[0] != RETRIEVAL_KEYWORD and model_name not in query_vectors:
+            query_vectors[model_name] = get_model_embeddings(entry.emb_moddle).embed_query(query)
+
+    # 并行检索各知识库
+    per_kb_k = min(per_kb_quota, top_k) if per_kb_quota else top_k
+    futures = []
+    for entry, vs in stores:
+        query_vector = query_vectors.get(resolve_model_name(entry.emb_moddle))
+        futures.append(_search_pool.submit(_search_kb, vs, [query], None if query_vector is None else [query_vector],
+                                           per_kb_k, entry))
+    ranked_lists = []
+    kb_stats = {}
+    for (entry, _), future in zip(stores, futures):
+        try:
+            ranked, kb_stats[entry.kon_name] = future.result()
+            ranked_lists.append([(score, entry.kon_name, doc) for score, doc in ranked[0]])
+        except Exception as e:
+            print(f"🔥 检索知识库 {entry.kon_name} 出错: {str(e)}")
+
+    results = _merge(ranked_lists, top_k, per_kb_quota)
+
+    if metrics is not None:
+        retrieved = sum(stats["retrieved"] for stats in kb_stats.values())
+        below_threshold = sum(stats["below_threshold"] for stats in kb_stats.values())
+        score_gap = sum(stats["score_gap"] for stats in kb_stats.values())
+        returned = Counter(name for _, _, name in results)
+        metrics.update({
+            "retrieved": retrieved,
+            "dropped_below_threshold": below_threshold,
+            "dropped_by_merge": retrieved - below_threshold - score_gap - len(results),
+            "dropped_by_score_gap": score_gap,
+            "returned": len(results),
+            "knowledge_bases": {name: dict(stats, returned=returned[name]) for name, stats in kb_stats.items()},
+            "skipped_knowledge_bases": [name for name in kon_names if not returned[name]]
+        })
+    return results
+
+
+def search_multiple_kbs(kon_names: List[str], query: str, top_k: int = 5) -> List[Document]:
+    return [doc for doc, _, _ in search_multiple_kbs_with_scores(kon_names, query, top_k)]
+
+
+def embed_queries(emb_model, queries):
+    """
+    按服务端单次请求的条数上限分批、并发向量化查询（限流和重试与构建知识库时相同）
+    使用查询类型向量化，与单条检索的 embed_query 结果一致
+    Returns:
+        np.ndarray (查询数, 维度)
+    """
+    executor = EmbeddingExecutor(get_model_embeddings(emb_model), text_type="query")
+    return np.asarray(executor.embed(list(queries)), dtype=np.float32)
+
+
+def search_multiple_kbs_batch(kon_names: List[str], queries: List[str], top_k: int = 5,
+                              per_kb_quota: int = None, adaptive: bool = True) -> List[List[Tuple[Document, float, str]]]:
+    """
+    批量联合检索：每个 Embedding 模型分批向量化所有查询，每个知识库用查询矩阵做一次 index.search
+    Args:
+        kon_names: 知识库名称列表
+        queries: 查询文本列表
+        top_k: 每个查询返回的文档数
+        per_kb_quota: 单个知识库最多贡献的文档数
+        adaptive: 是否按向量相似度断层做自适应截断（与对话检索相同，可能返回少于 top_k 个结果），False 时不截断
+    Returns:
+        与 queries 一一对应的 [(doc, score, kon_name)]，按分数降序
+    """
+    if not queries:
+        return []
+    stores = _load_stores(kon_names)
+
+    # 相同的查询只检索一次
+    unique_queries = list(dict.fromkeys(queries))
+    query_matrices = {}
+    for entry, _ in stores:
+        model_name = resolve_model_name(entry.emb_moddle)
+        if parse_similarity(entry.similarity)[0] != RETRIEVAL_KEYWORD and model_name not in query_matrices:
+            query_matrices[model_name] = embed_queries(entry.emb_moddle, unique_queries)
+
+    per_kb_k = min(per_kb_quota, top_k) if per_kb_quota else top_k
+    futures = [
+        _search_pool.submit(_search_kb, vs, unique_queries, query_matrices.get(resolve_model_name(entry.emb_moddle)),
+                            per_kb_k, entry, ADAPTIVE_SCORE_GAP if adaptive else 0)
+        for entry, vs in stores
+    ]
+    per_query_lists = [[] for _ in unique_queries]
+    for (entry, _), future in zip(stores, futures):
+        try:
+            ranked, _ = future.result()
+        except Exception as e:
+            print(f"🔥 检索知识库 {entry.kon_name} 出错: {str(e)}")
+            continue
+        for lists, hits in zip(per_query_lists, ranked):
+            lists.append([(score, entry.kon_name, doc) for score, doc in hits])
+
+    merged = {query: _merge(lists, top_k, per_kb_quota) for query, lists in zip(unique_queries, per_query_lists)}
+    return [merged[query] for query in queries]
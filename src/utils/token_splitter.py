@@ -0,0 +1,139 @@
+# src/utils/token_splitter.py
+import copy
+import logging
+import os
+import re
+import threading
+
+from langchain.schema import Document
+
+# 用于计算 token 长度的分词器（需为 fast tokenizer），可以是 Hugging Face 模型名称或本地目录（离线部署时使用本地目录）
+# 默认与 agent.py 统计 token 使用相同的 gpt2；Qwen2 等新分词器需要 transformers >= 4.37
+CHUNK_TOKENIZER = os.environ.get("KBS_CHUNK_TOKENIZER", "gpt2")
+# 句子边界（中英文标点与换行），切分后保留标点
+_SENTENCE_BOUNDARY = re.compile(r'(?<=[。！？；!?;\n])')
+
+_tokenizer = None
+_tokenizer_loaded = False
+_tokenizer_lock = threading.Lock()
+
+
+def get_tokenizer():
+    """
+    获取全局共享的 fast tokenizer（首次使用时加载，之后所有构建复用）
+    Returns:
+        分词器，加载失败时返回 None（按字符数切分）
+    """
+    global _tokenizer, _tokenizer_loaded
+    if not _tokenizer_loaded:
+        with _tokenizer_lock:
+            if not _tokenizer_loaded:
+                try:
+                    from transformers import AutoTokenizer
+                    _tokenizer = AutoTokenizer.from_pretrained(CHUNK_TOKENIZER, use_fast=True)
+                except Exception as e:
+                    logging.warning(f"加载分词器 {CHUNK_TOKENIZER} 失败，改为按字符数切分: {str(e)}")
+                    _tokenizer = None
+                _tokenizer_loaded = True
+    return _tokenizer
+
+
+def count_tokens(texts):
+    """
+    批量计算 token 数（一次调用分词器处理整批文本），分词器不可用时返回字符数
+    """
+    if not texts:
+        return []
+    tokenizer = get_tokenizer()
+    if tokenizer is None:
+        return [len(text) for text in texts]
+    encoded = tokenizer(list(texts), add_special_tokens=False, return_attention_mask=False)
+    return [len(ids) for ids in encoded["input_ids"]]
+
+
+class TokenTextSplitter:
+    """
+    按 token 数切分文档
+    先按分隔符和句子边界切成小片段，整批计算 token 数后再贪心合并，
+    避免 LangChain 切分器对每个候选片段单独调用长度函数。
+    """
+
+    def __init__(self, chunk_size, chunk_overlap, separator=None):
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.separator = separator
+
+    def _split_units(self, text):
+        pieces = text.split(self.separator) if self.separator else [text]
+        units = []
+        for i, piece in enumerate(pieces):
+            piece_units = [u for u in _SENTENCE_BOUNDARY.split(piece) if u.strip()]
+            if self.separator and i > 0 and piece_units:
+                # 分隔符（如 "\n\n"）拼回后面片段的开头，合并后段落之间仍保留分隔
+                piece_units[0] = self.separator + piece_units[0]
+            units.extend(piece_units)
+        return units
+
+    def _split_long_unit(self, text):
+        """
+        单个片段超过 chunk_size 时按 token 偏移切开（分词器不可用时按字符切开）
+        """
+        tokenizer = get_tokenizer()
+        if tokenizer is None:
+            return [(text[start:start + self.chunk_size], len(text[start:start + self.chunk_size]))
+                    for start in range(0, len(text), self.chunk_size)]
+        encoded = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+        offsets = encoded["offset_mapping"]
+        parts = []
+        for start in range(0, len(offsets), self.chunk_size):
+            window = offsets[start:start + self.chunk_size]
+            parts.append((text[window[0][0]:window[-1][1]], len(window)))
+        return parts
+
+    def split_documents(self, documents):
+        documents = list(documents)
+        doc_units = [self._split_units(doc.page_content) for doc in documents]
+
+        # 整批计算所有片段的 token 数
+        flat_units = [unit for units in doc_units for unit in units]
+        flat_lengths = count_tokens(flat_units)
+
+        result = []
+        position = 0
+        for doc, units in zip(documents, doc_units):
+            lengths = flat_lengths[position:position + len(units)]
+            position += len(units)
+
+            pieces = []
+            for unit, length in zip(units, lengths):
+                if length > self.chunk_size:
+                    pieces.extend(self._split_long_unit(unit))
+                else:
+                    pieces.append((unit, length))
+
+            for text in self._merge(pieces):
+                result.append(Document(page_content=text, metadata=copy.deepcopy(doc.metadata)))
+        return result
+
+    def _merge(self, pieces):
+        chunks = []
+        current = []
+        total = 0
+        for text, length in pieces:
+            if current and total + length > self.chunk_size:
+                chunks.append("".join(t for t, _ in current).strip())
+                # 保留末尾不超过 chunk_overlap 个 token 的片段作为重叠
+                overlap = []
+                overlap_total = 0
+                for item in reversed(current):
+                    if overlap_total + item[1] > self.chunk_overlap or overlap_total + item[1] + length > self.chunk_size:
+                        break
+                    overlap.insert(0, item)
+                    overlap_total += item[1]
+                current = overlap
+                total = overlap_total
+            current.append((text, length))
+            total += length
+        if current:
+            chunks.append("".join(t for t, _ in current).strip())
+        return [chunk for chunk in chunks if chunk]
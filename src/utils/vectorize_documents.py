@@ -1,34 +1,125 @@
 from langchain_community.embeddings import DashScopeEmbeddings
 from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
 import logging
 import os
+import json
 import pickle
+import zlib
 import faiss
-import tempfile
+import numpy as np
+from collections import Counter
+from langchain.schema import Document
 
-def vectorize_documents(documents, kon_name, emb_model):
-    try:
-        # 支持的阿里云Embedding模型
-        supported_models = {
-            "text-embedding-v1": "embedding-v1",
-            "text-embedding-v2": "embedding-v2",
-            "text-embedding-async-001": "embedding-async"
-        }
+from src.utils.embedding_cache import get_embedding_cache, text_hash
+from src.utils.embedding_executor import EmbeddingExecutor
+from src.utils.faiss_index import build_index, benchmark_index, apply_search_params, rebuild_index
+from src.utils.sparse_index import BM25Index
+
+# 每批向量化的文档数（DashScope 单次请求上限为 25 条）
+EMBED_BATCH_SIZE = 25
+
+# docstore 编码格式的文件头，没有该文件头的 pkl_index_data 为旧的 pickle 整库格式
+DOCSTORE_MAGIC = b"KBSDOC1\n"
+
+# 支持的阿里云Embedding模型
+SUPPORTED_MODELS = {
+    "text-embedding-v1": "embedding-v1",
+    "text-embedding-v2": "embedding-v2",
+    "text-embedding-async-001": "embedding-async"
+}
+
+
+def resolve_model_name(emb_model):
+    """
+    根据知识库选择的模型获取实际使用的 Embedding 模型名称
+    """
+    if emb_model in SUPPORTED_MODELS:
+        return SUPPORTED_MODELS[emb_model]
+    # 默认使用 text-embedding-v2（推荐）
+    return "text-embedding-v2"
+
+
+def get_embeddings(emb_model):
+    """
+    创建Embeddings对象
+    """
+    return DashScopeEmbeddings(
+        model=resolve_model_name(emb_model),
+        dashscope_api_key="your-key"
+    )
+
+
+def embed_documents(documents, embeddings, progress_callback=None):
+    """
+    分批向量化文档，以便上报进度
+    相同文本只向量化一次，并优先从持久化的 Embedding 缓存中读取，未命中的文本通过 EmbeddingExecutor 并发请求
+    Args:
+        documents: 文档块列表
+        embeddings: Embeddings对象
+        progress_callback: 每完成一批调用 progress_callback(chunks_embedded, chunks_total)
+    Returns:
+        list: 与 documents 一一对应的向量
+    """
+    hashes = [text_hash(doc.page_content) for doc in documents]
+    counts = Counter(hashes)
+    # 去重后的文本，保持首次出现的顺序
+    unique_texts = {}
+    for h, doc in zip(hashes, documents):
+        unique_texts.setdefault(h, doc.page_content)
 
-        # 根据选择的模型设置参数
-        if emb_model in supported_models:
-            model_name = supported_models[emb_model]
-        else:
-            # 默认使用 text-embedding-v2（推荐）
-            model_name = "text-embedding-v2"
+    model = getattr(embeddings, 'model', type(embeddings).__name__)
+    cache = get_embedding_cache()
+    vectors = cache.get_many(model, list(unique_texts))
 
+    done = sum(counts[h] for h in vectors)
+    if progress_callback is not None:
+        progress_callback(done, len(documents))
+
+    missing = [h for h in unique_texts if h not in vectors]
+
+    def on_batch(start, batch_vectors):
+        nonlocal done
+        batch = missing[start:start + len(batch_vectors)]
+        new_vectors = dict(zip(batch, batch_vectors))
+        cache.put_many(model, new_vectors)
+        vectors.update(new_vectors)
+        done += sum(counts[h] for h in batch)
+
+    def on_progress(_, __):
+        if progress_callback is not None:
+            progress_callback(done, len(documents))
+
+    # 批量、并发、限流地调用 Embedding 接口
+    executor = EmbeddingExecutor(embeddings, batch_size=EMBED_BATCH_SIZE)
+    executor.embed([unique_texts[h] for h in missing], progress_callback=on_progress, on_batch=on_batch)
+
+    print(f"向量化 {len(documents)} 个文档块：去重后 {len(unique_texts)} 个，"
+          f"缓存命中 {len(unique_texts) - len(missing)} 个，调用接口 {len(missing)} 个")
+    return [vectors[h] for h in hashes]
+
+
+def vectorize_documents(documents, kon_name, emb_model, progress_callback=None,
+                        index_type="auto", index_params=None):
+    """
+    向量化文档并构建 FAISS 向量库
+    Args:
+        documents: 文档块列表
+        kon_name: 知识库名称
+        emb_model: Embedding 模型名称
+        progress_callback: 每完成一批调用 progress_callback(chunks_embedded, chunks_total)
+        index_type: 索引类型（auto / Flat / IVF-Flat / IVF-PQ / HNSW）
+        index_params: 索引参数（nlist、m、M、efConstruction、nprobe、efSearch）
+    Returns:
+        (vectorstore, index_info): index_info 包含实际使用的
+        index_type、index_params 和召回率/延迟评测结果 index_report
+    """
+    try:
+        model_name = resolve_model_name(emb_model)
         print(f"开始创建Embeddings对象，使用模型: {model_name}")
 
         # 创建Embeddings对象
-        embeddings = DashScopeEmbeddings(
-            model=model_name,
-            dashscope_api_key="your-key"
-        )
+        embeddings = get_embeddings(emb_model)
 
         print(f"开始向量化 {len(documents)} 个文档")
 
@@ -41,39 +132,150 @@ def vectorize_documents(documents, kon_name, emb_model):
             if not hasattr(doc, 'page_content') or not doc.page_content:
                 logging.warning(f"文档 {i} 内容为空")
 
-        vectorstore = FAISS.from_documents(documents, embeddings)
+        # 分批向量化，以便上报进度
+        texts = [doc.page_content for doc in documents]
+        vectors = embed_documents(documents, embeddings, progress_callback)
 
-        # 获取 FAISS 索引
-        index = vectorstore.index
+        # 按索引类型创建并训练索引，再添加向量
+        matrix = np.asarray(vectors, dtype=np.float32)
+        index, index_type, index_params = build_index(matrix, index_type, index_params)
+        vectorstore = FAISS(embeddings, index, InMemoryDocstore(), {})
+        ids = vectorstore.add_embeddings(
+            list(zip(texts, vectors)),
+            metadatas=[doc.metadata for doc in documents]
+        )
+        # 同时构建 BM25 稀疏索引，与 FAISS 索引一起保存
+        vectorstore.sparse_index = BM25Index.build(ids, texts)
+        index_report = benchmark_index(index, matrix, index_type, index_params)
 
-        # 使用临时文件存储索引
-        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-            temp_file_path = temp_file.name
+        return vectorstore, {
+            "index_type": index_type,
+            "index_params": index_params,
+            "index_report": index_report
+        }
 
-        # 将索引写入临时文件
-        faiss.write_index(index, temp_file_path)
+    except Exception as e:
+        logging.error(f"向量化文档失败: {str(e)}", exc_info=True)
+        raise Exception(f"向量化文档失败: {str(e)}")
 
-        # 读取临时文件内容到内存
-        with open(temp_file_path, 'rb') as f:
-            faiss_index_data = f.read()
 
-        # 删除临时文件
-        os.unlink(temp_file_path)
+def encode_docstore(docstore, index_to_docstore_id):
+    """
+    编码 docstore 和向量位置映射（不含索引）：文件头 + zlib 压缩的 JSON
+    """
+    docs = docstore._dict
+    ids = [doc_id for _, doc_id in sorted(index_to_docstore_id.items())]
+    payload = {
+        "ids": ids,
+        "docs": [[docs[doc_id].page_content, docs[doc_id].metadata] for doc_id in ids]
+    }
+    raw = json.dumps(payload, ensure_ascii=False, separators=(',', ':'), default=str).encode('utf-8')
+    return DOCSTORE_MAGIC + zlib.compress(raw)
 
-        # 安全获取文档数量
-        n_vectors = len(vectorstore.docstore._dict)  # 直接访问 docs 属性
 
-        index_info = {
-            "dimension": index.d,
-            "n_vectors": n_vectors,
-            "embedding_model": model_name
-        }
+def decode_docstore(data):
+    """
+    解码 docstore，兼容旧的 pickle 整库格式（其中重复存储的索引会被丢弃）
+    Returns:
+        (docstore, index_to_docstore_id)
+    """
+    if isinstance(data, str):
+        data = data.encode('latin1')
+    view = memoryview(data)
+    if bytes(view[:len(DOCSTORE_MAGIC)]) == DOCSTORE_MAGIC:
+        payload = json.loads(zlib.decompress(view[len(DOCSTORE_MAGIC):]))
+        docstore = InMemoryDocstore({
+            doc_id: Document(page_content=content, metadata=metadata)
+            for doc_id, (content, metadata) in zip(payload["ids"], payload["docs"])
+        })
+        return docstore, dict(enumerate(payload["ids"]))
 
-        # 序列化索引信息为 pickle 数据
-        faiss_index_data = faiss.serialize_index(vectorstore.index).tobytes()
-        pkl_data = vectorstore.serialize_to_bytes()  # 整库序列化
-        return faiss_index_data, pkl_data
+    legacy = pickle.loads(data)
+    # FAISS.serialize_to_bytes 的格式为 (index, docstore, index_to_docstore_id)
+    docstore, index_to_docstore_id = legacy[-2:]
+    return docstore, index_to_docstore_id
 
-    except Exception as e:
-        logging.error(f"向量化文档失败: {str(e)}", exc_info=True)
-        raise Exception(f"向量化文档失败: {str(e)}")
+
+def is_legacy_docstore(data):
+    """
+    pkl_index_data 是否为旧的 pickle 整库格式
+    """
+    if isinstance(data, str):
+        data = data.encode('latin1')
+    return bool(data) and bytes(memoryview(data)[:len(DOCSTORE_MAGIC)]) != DOCSTORE_MAGIC
+
+
+def serialize_vectorstore(vectorstore):
+    """
+    序列化向量库：索引只存一份，docstore 单独编码
+    Returns:
+        (faiss_index_data, pkl_index_data)
+    """
+    faiss_index_data = faiss.serialize_index(vectorstore.index).tobytes()
+    return faiss_index_data, encode_docstore(vectorstore.docstore, vectorstore.index_to_docstore_id)
+
+
+def load_vectorstore(faiss_data, pkl_data, embeddings, index_params=None):
+    """
+    从数据库中的二进制数据反序列化向量库
+    Args:
+        index_params: 知识库的索引参数，其中的 nprobe / efSearch 在加载时生效
+    """
+    if isinstance(faiss_data, str):
+        faiss_data = faiss_data.encode('latin1')
+
+    # 直接在原始字节上构造数组视图，不额外复制
+    index = faiss.deserialize_index(np.frombuffer(faiss_data, dtype=np.uint8))
+    apply_search_params(index, index_params)
+    docstore, index_to_docstore_id = decode_docstore(pkl_data)
+    return FAISS(embeddings, index, docstore, index_to_docstore_id)
+
+
+def add_documents_to_vectorstore(vectorstore, documents, embeddings, progress_callback=None):
+    """
+    只向量化新增的文档块并追加到已有索引
+    Returns:
+        list: 新增文档块的 docstore id
+    """
+    if not documents:
+        return []
+    vectors = embed_documents(documents, embeddings, progress_callback)
+    texts = [doc.page_content for doc in documents]
+    ids = vectorstore.add_embeddings(
+        list(zip(texts, vectors)),
+        metadatas=[doc.metadata for doc in documents]
+    )
+    if getattr(vectorstore, 'sparse_index', None) is not None:
+        vectorstore.sparse_index.add(ids, texts)
+    return ids
+
+
+def delete_documents_by_source(vectorstore, source_urls):
+    """
+    根据文档块的 source_url 元数据删除向量
+    Returns:
+        int: 删除的文档块数量
+    """
+    source_urls = set(source_urls)
+    docs = vectorstore.docstore._dict
+    reversed_index = {doc_id: i for i, doc_id in vectorstore.index_to_docstore_id.items()}
+    ids = [doc_id for doc_id in reversed_index
+           if doc_id in docs and docs[doc_id].metadata.get('source_url') in source_urls]
+    if not ids:
+        return 0
+
+    positions = {reversed_index[doc_id] for doc_id in ids}
+    remaining = [(i, doc_id) for i, doc_id in sorted(vectorstore.index_to_docstore_id.items()) if i not in positions]
+    if isinstance(faiss.downcast_index(vectorstore.index), faiss.IndexFlat):
+        vectorstore.index.remove_ids(np.array(sorted(positions), dtype=np.int64))
+    else:
+        # HNSW 不支持删除，IVF 删除后不压缩编号，都用剩余向量重建
+        vectorstore.index = rebuild_index(vectorstore.index, [i for i, _ in remaining])
+    vectorstore.docstore.delete(ids)
+    if getattr(vectorstore, 'sparse_index', None) is not None:
+        vectorstore.sparse_index.remove(ids)
+
+    # 重新编号剩余向量（IndexFlat 的 remove_ids 会压缩索引，其余索引已按新顺序重建）
+    remaining_ids = [doc_id for _, doc_id in remaining]
+    vectorstore.index_to_docstore_id = {i: doc_id for i, doc_id in enumerate(remaining_ids)}
+    return len(ids)
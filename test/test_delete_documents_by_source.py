@@ -0,0 +1,56 @@
+# test_delete_documents_by_source.py
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+
+from src.utils.faiss_index import build_index
+from src.utils.vectorize_documents import delete_documents_by_source
+
+
+def make_vectorstore(vectors, sources, index_type):
+    index, _, _ = build_index(vectors, index_type, {"nlist": 8})
+    vectorstore = FAISS(None, index, InMemoryDocstore(), {})
+    vectorstore.add_embeddings(
+        [(f"chunk-{i}", vector.tolist()) for i, vector in enumerate(vectors)],
+        metadatas=[{"source_url": source} for source in sources]
+    )
+    return vectorstore
+
+
+def search_texts(vectorstore, vector, k=1):
+    docs = vectorstore.similarity_search_with_score_by_vector(vector.tolist(), k=k)
+    return [doc.page_content for doc, _ in docs]
+
+
+def test_delete_documents_by_source_ivf():
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((600, 16)).astype(np.float32)
+    sources = ["a.txt" if i % 2 == 0 else "b.txt" for i in range(len(vectors))]
+    vectorstore = make_vectorstore(vectors, sources, "IVF-Flat")
+    vectorstore.index.nprobe = 8
+
+    deleted = delete_documents_by_source(vectorstore, ["a.txt"])
+    assert deleted == 300
+    assert vectorstore.index.ntotal == 300
+    assert vectorstore.index.nprobe == 8
+
+    # 删除后检索：每个剩余向量都应检索到自身对应的文档块
+    for i in range(1, len(vectors), 2):
+        assert search_texts(vectorstore, vectors[i]) == [f"chunk-{i}"]
+
+    # 再次添加后，新旧文档块的编号不冲突
+    new_vectors = rng.standard_normal((50, 16)).astype(np.float32)
+    vectorstore.add_embeddings(
+        [(f"new-{i}", vector.tolist()) for i, vector in enumerate(new_vectors)],
+        metadatas=[{"source_url": "c.txt"} for _ in new_vectors]
+    )
+    assert vectorstore.index.ntotal == len(vectorstore.index_to_docstore_id) == 350
+    for i in range(len(new_vectors)):
+        assert search_texts(vectorstore, new_vectors[i]) == [f"new-{i}"]
+    for i in range(1, len(vectors), 2):
+        assert search_texts(vectorstore, vectors[i]) == [f"chunk-{i}"]
+
+
+if __name__ == "__main__":
+    test_delete_documents_by_source_ivf()
+    print("测试通过")